@@ -0,0 +1,353 @@
+"""
+Offline benchmark of the SafeClean cleanup pipeline.
+
+Runs every kind of safeclean cleanup against simulated text channels,
+without connecting to Discord. Channels hold synthetic histories and
+model the history page size, the bulk delete limits and per-channel
+rate limit buckets. For each scenario it records the wall time, the
+simulated API time, the API calls by type, the peak memory and the
+messages deleted per second.
+
+The cleanups go through the cog's own job runner (`build_check`,
+`process_job`, the message index and the deletion engine); only the
+command argument parsing and the Red config are left out.
+
+Usage, from the repository root with the bot's requirements installed:
+
+    python benchmarks/safeclean_bench.py --size 20000 --old-ratio 0.2
+    python benchmarks/safeclean_bench.py --indexed --json > before.json
+"""
+import argparse
+import asyncio
+import bisect
+import json
+import random
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import discord  # noqa: E402
+
+from safeclean.converters import MessageBound  # noqa: E402
+from safeclean.index import MessageIndex  # noqa: E402
+from safeclean.jobs import PurgeJob, channel_state  # noqa: E402
+from safeclean.purge import BULK_DELETE_LIMIT  # noqa: E402
+from safeclean.safeclean import SafeClean  # noqa: E402
+
+DAY = 24 * 60 * 60
+BOT_ID = 1
+USERS = 50
+SPAMMER_ID = 1000
+KEYWORD = "free nitro"
+PREFIX = "!"
+COMMANDS = ("ping", "help", "info")
+
+
+def snowflake(timestamp: float, sequence: int) -> int:
+    return (int(timestamp * 1000 - discord.utils.DISCORD_EPOCH) << 22) | (sequence & 0x3FFFFF)
+
+
+def http_error(cls, status: int, reason: str):
+    response = SimpleNamespace(status=status, reason=reason, headers={})
+    return cls(response, reason)
+
+
+class Bucket:
+    """A rate limit bucket allowing ``limit`` calls per ``per`` simulated seconds."""
+
+    def __init__(self, limit: int, per: float, scale: float):
+        self.limit = limit
+        self.per = per * scale
+        self.calls = []
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            loop = asyncio.get_event_loop()
+            while True:
+                now = loop.time()
+                self.calls = [call for call in self.calls if call > now - self.per]
+                if len(self.calls) < self.limit:
+                    self.calls.append(now)
+                    return
+                await asyncio.sleep(self.calls[0] + self.per - now)
+
+
+class FakeMessage:
+    __slots__ = ("id", "author", "pinned", "content", "channel")
+
+    def __init__(self, message_id: int, author_id: int, pinned: bool, content: str):
+        self.id = message_id
+        self.author = discord.Object(id=author_id)
+        self.pinned = pinned
+        self.content = content
+
+
+class FakeChannel:
+    """A stand-in `discord.TextChannel` with a synthetic history and rate limits."""
+
+    def __init__(self, channel_id: int, guild, messages, args, stats: Counter):
+        self.id = channel_id
+        self.name = "bench-{}".format(channel_id)
+        self.guild = guild
+        self.stats = stats
+        self.scale = args.time_scale
+        self.latency = args.latency
+        self.messages = {message.id: message for message in messages}
+        for message in messages:
+            message.channel = self
+        self.ids = sorted(self.messages)
+        self.buckets = {
+            "history": Bucket(args.history_limit, 1, self.scale),
+            "bulk_delete": Bucket(1, 1, self.scale),
+            "single_delete": Bucket(5, 5, self.scale),
+        }
+
+    async def call(self, route: str):
+        await self.buckets[route].acquire()
+        self.stats[route] += 1
+        await asyncio.sleep(self.latency * self.scale)
+
+    async def history(self, limit=None, before=None, after=None, oldest_first=False):
+        """Newest first, one simulated API call per page of 100 messages."""
+        upper = bisect.bisect_left(self.ids, before.id) if before is not None else len(self.ids)
+        lower = bisect.bisect_right(self.ids, after.id) if after is not None else 0
+        while upper > lower:
+            await self.call("history")
+            page = []
+            while upper > lower and len(page) < BULK_DELETE_LIMIT:
+                upper -= 1
+                message = self.messages.get(self.ids[upper])
+                if message is not None:
+                    page.append(message)
+            for message in page:
+                yield message
+
+    async def delete_messages(self, messages):
+        messages = list(messages)
+        if len(messages) == 1:
+            await self.call("single_delete")
+            if self.messages.pop(messages[0].id, None) is None:
+                raise http_error(discord.NotFound, 404, "Unknown Message")
+            return
+        if len(messages) > BULK_DELETE_LIMIT:
+            raise discord.ClientException("Can only bulk delete messages up to 100 messages")
+        await self.call("bulk_delete")
+        cutoff = snowflake(time.time() - 14 * DAY, 0)
+        if any(message.id < cutoff for message in messages):
+            raise http_error(discord.HTTPException, 400, "Message too old for bulk delete")
+        for message in messages:
+            self.messages.pop(message.id, None)
+
+
+class MemoryValue:
+    def __init__(self, value):
+        self.value = value
+
+    async def __call__(self):
+        return self.value
+
+
+class MemoryGroup:
+    """Keeps job checkpoints as JSON, like the config would."""
+
+    def __init__(self, stats: Counter):
+        self.data = {}
+        self.stats = stats
+
+    async def set_raw(self, *identifiers, value):
+        self.stats["checkpoint"] += 1
+        self.data[identifiers[0]] = json.dumps(value)
+
+    async def clear_raw(self, *identifiers):
+        self.data.pop(identifiers[0], None)
+
+
+class MemoryConfig:
+    def __init__(self, concurrency: int, stats: Counter):
+        self.jobs = MemoryGroup(stats)
+        self.concurrency = concurrency
+
+    def guild(self, guild):
+        return SimpleNamespace(channel_concurrency=MemoryValue(self.concurrency))
+
+
+class FakeBot:
+    def __init__(self, guild):
+        self.guild = guild
+        self.user = discord.Object(id=BOT_ID)
+        self.all_commands = {name: None for name in COMMANDS}
+
+    def get_guild(self, guild_id):
+        return self.guild if guild_id == self.guild.id else None
+
+    def get_channel(self, channel_id):
+        return self.guild.channels.get(channel_id)
+
+    def get_cog(self, name):
+        return None
+
+
+def synthetic_history(args, rng: random.Random, channel_index: int):
+    """Builds a channel history spread over ``args.age_days`` up to now."""
+    now = time.time()
+    timestamps = sorted(
+        now - (args.age_days * DAY if rng.random() < args.old_ratio else 13 * DAY) * rng.random()
+        for _ in range(args.size)
+    )
+    messages = []
+    for sequence, timestamp in enumerate(timestamps):
+        roll = rng.random()
+        if roll < 0.05:
+            author, content = BOT_ID, "Done."
+        elif roll < 0.1:
+            author, content = rng.randrange(2, USERS), PREFIX + rng.choice(COMMANDS)
+        elif roll < 0.15:
+            author, content = SPAMMER_ID, "get {} here".format(KEYWORD)
+        else:
+            author, content = rng.randrange(2, USERS), "hello " * rng.randrange(1, 60)
+        messages.append(
+            FakeMessage(
+                snowflake(timestamp, channel_index << 17 | sequence),
+                author,
+                rng.random() < args.pinned_ratio,
+                content,
+            )
+        )
+    return messages
+
+
+SCENARIOS = ("messages", "user", "text", "self", "bot", "after", "before", "between", "guild user")
+
+
+def scenario(name: str, channels, number: int):
+    """The filter and channel states a safeclean subcommand would start its job with."""
+    first = channels[0]
+    newest = discord.Object(id=first.ids[-1] + 1)
+    middle = first.ids[len(first.ids) // 2]
+    quarter = first.ids[len(first.ids) // 4]
+
+    def recent(spec):
+        return spec, {first.id: channel_state(number=number, before=newest)}
+
+    if name == "messages":
+        return recent({"type": "all"})
+    if name == "user":
+        return recent({"type": "user", "user_id": SPAMMER_ID})
+    if name == "text":
+        return recent({"type": "text", "pattern": KEYWORD})
+    if name == "self":
+        return recent({"type": "self", "pattern": None})
+    if name == "bot":
+        return recent({"type": "bot", "prefixes": [PREFIX]})
+    if name == "after":
+        return {"type": "all"}, {first.id: channel_state(after=discord.Object(id=middle))}
+    if name == "before":
+        bound = MessageBound(id=middle)
+        return {"type": "all"}, {
+            first.id: channel_state(number=number, before=bound, verify_before=True)
+        }
+    if name == "between":
+        bound = MessageBound(id=middle)
+        after = discord.Object(id=quarter)
+        return {"type": "all"}, {
+            first.id: channel_state(before=bound, after=after, verify_before=True)
+        }
+    if name == "guild user":
+        return {"type": "user", "user_id": SPAMMER_ID}, {
+            channel.id: channel_state(number=number, before=newest) for channel in channels
+        }
+    raise ValueError(name)
+
+
+class FakeAuthor:
+    id = 2
+
+    def __str__(self):
+        return "bench#0000"
+
+
+async def run_scenario(args, name: str) -> dict:
+    rng = random.Random(args.seed)
+    stats = Counter()
+    guild = SimpleNamespace(id=1, channels={})
+    channels = [
+        FakeChannel(channel_id, guild, synthetic_history(args, rng, channel_id), args, stats)
+        for channel_id in range(10, 10 + args.channels)
+    ]
+    guild.channels = {channel.id: channel for channel in channels}
+    spec, states = scenario(name, channels, args.number)
+
+    cog = object.__new__(SafeClean)
+    cog.bot = FakeBot(guild)
+    cog.config = MemoryConfig(args.concurrency, stats)
+    cog.index = MessageIndex()
+    cog.jobs = {}
+    if args.indexed:
+        for channel in channels:
+            for message_id in channel.ids:
+                cog.index.add(channel.messages[message_id])
+
+    ctx = SimpleNamespace(guild=guild, channel=channels[0], author=FakeAuthor())
+    job = PurgeJob.new(0, ctx, filter=spec, channels=states, description=name)
+    check, settled = await cog.build_check(job.data)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    failed = await cog.process_job(job, check, settled)
+    wall = time.perf_counter() - started
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    simulated = wall / args.time_scale
+    return {
+        "scenario": name,
+        "deleted": job.deleted,
+        "failed_channels": len(failed),
+        "wall_s": round(wall, 3),
+        "simulated_s": round(simulated, 1),
+        "messages_per_s": round(job.deleted / simulated, 1) if simulated else 0.0,
+        "peak_kib": round(peak / 1024, 1),
+        "api_calls": dict(stats),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of SafeClean cleanups.")
+    parser.add_argument("--size", type=int, default=5000, help="messages per channel")
+    parser.add_argument("--channels", type=int, default=4, help="channels for guild-wide runs")
+    parser.add_argument("--number", type=int, default=1000, help="X in 'last X messages'")
+    parser.add_argument("--pinned-ratio", type=float, default=0.01)
+    parser.add_argument("--old-ratio", type=float, default=0.1, help="share older than 14 days")
+    parser.add_argument("--age-days", type=float, default=60, help="age of the oldest message")
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds per API call")
+    parser.add_argument("--history-limit", type=int, default=5, help="history pages per second")
+    parser.add_argument("--concurrency", type=int, default=4, help="guild-wide channel limit")
+    parser.add_argument("--time-scale", type=float, default=0.01, help="real/simulated time")
+    parser.add_argument("--indexed", action="store_true", help="fill the message index first")
+    parser.add_argument("--only", nargs="*", choices=SCENARIOS, help="scenarios to run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print JSON lines")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    for name in args.only or SCENARIOS:
+        result = loop.run_until_complete(run_scenario(args, name))
+        if args.json:
+            print(json.dumps(result))
+            continue
+        calls = ", ".join("{}={}".format(*item) for item in sorted(result["api_calls"].items()))
+        print(
+            "{scenario:<12} deleted={deleted:<6} wall={wall_s:>7}s "
+            "simulated={simulated_s:>8}s rate={messages_per_s:>7}/s "
+            "peak={peak_kib:>9}KiB  {calls}".format(calls=calls, **result)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""
+Ingestion benchmark of the Stats cog.
+
+Feeds synthetic message and voice events through the cog's listeners,
+against guild databases in a temporary directory, with the real flush
+loop and store threads running. For each run it records the events
+handled per second, the p50/p99 latency of the listener calls, the
+depth of each guild's write queue over time and the final size of the
+databases.
+
+Runs cover every combination of member count and burst shape:
+
+- ``flood``: events back to back, as fast as the listeners take them
+- ``steady``: ``--rate`` events per second, spread over 10ms ticks
+- ``burst``: ``--rate`` events per second, all sent at the start of
+  each ``--period``
+
+Usage, from the repository root with the bot's requirements installed:
+
+    python benchmarks/stats_bench.py --events 200000 --users 100 10000
+    python benchmarks/stats_bench.py --shapes burst --json > before.json
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import discord  # noqa: E402
+
+from stats.stats import Stats  # noqa: E402
+
+SHAPES = ("flood", "steady", "burst")
+TICK = 0.01
+
+
+class FakeBot:
+    def __init__(self, loop, guilds):
+        self.loop = loop
+        self.guilds = guilds
+
+    def get_cog(self, name):
+        return None
+
+
+def text_channel(guild):
+    channel = object.__new__(discord.TextChannel)
+    channel.id = guild.id + 1
+    channel.guild = guild
+    return channel
+
+
+def synthetic_events(args, rng: random.Random, users: int, guilds):
+    """Yields (listener name, args) pairs; voice events are join/leave pairs over time."""
+    members = [
+        SimpleNamespace(id=user_id, bot=False, guild=guilds[user_id % len(guilds)])
+        for user_id in range(users)
+    ]
+    channels = {guild.id: text_channel(guild) for guild in guilds}
+    in_voice = set()
+    voice = SimpleNamespace(channel=object())
+    away = SimpleNamespace(channel=None)
+    for _ in range(args.events):
+        member = rng.choice(members)
+        if rng.random() < args.voice_ratio:
+            if member.id in in_voice:
+                in_voice.discard(member.id)
+                yield "on_voice_state_update", (member, voice, away)
+            else:
+                in_voice.add(member.id)
+                yield "on_voice_state_update", (member, away, voice)
+        else:
+            message = SimpleNamespace(
+                author=member, guild=member.guild, channel=channels[member.guild.id]
+            )
+            yield "on_message_without_command", (message,)
+
+
+def database_size(path: Path) -> int:
+    return sum(file.stat().st_size for file in path.glob("*.db*"))
+
+
+async def sample_queues(cog, samples, started, every):
+    """Records (seconds, pending writes, buffered counters) of every store each tick."""
+    while True:
+        stores = list(cog.stores.values())
+        samples.append(
+            (
+                round(time.perf_counter() - started, 2),
+                sum(store._executor._work_queue.qsize() for store in stores),
+                sum(len(store.message_counts) + len(store.voice_times) for store in stores),
+            )
+        )
+        await asyncio.sleep(every)
+
+
+async def run(args, users: int, shape: str) -> dict:
+    rng = random.Random(args.seed)
+    guilds = [SimpleNamespace(id=(index + 1) << 22) for index in range(args.guilds)]
+    events = list(synthetic_events(args, rng, users, guilds))
+
+    with tempfile.TemporaryDirectory() as directory:
+        loop = asyncio.get_event_loop()
+        cog = object.__new__(Stats)
+        cog.bot = FakeBot(loop, guilds)
+        cog._path = Path(directory)
+        cog._legacy_path = Path(directory) / "stats.db"
+        cog._legacy_owner = concurrent.futures.Future()
+        cog._legacy_owner.set_result(None)
+        cog.stores = {}
+        cog.flush_task = loop.create_task(cog.flush_loop())
+
+        latencies = []
+        samples = []
+        started = time.perf_counter()
+        sampler = loop.create_task(sample_queues(cog, samples, started, args.sample_every))
+        per_tick = max(1, round(args.rate * TICK))
+        per_burst = max(1, round(args.rate * args.period))
+        for position, (name, event) in enumerate(events, 1):
+            before = time.perf_counter()
+            await getattr(cog, name)(*event)
+            latencies.append(time.perf_counter() - before)
+            if shape == "steady" and position % per_tick == 0:
+                await asyncio.sleep(TICK)
+            elif shape == "burst" and position % per_burst == 0:
+                await asyncio.sleep(args.period)
+            elif shape == "flood" and position % 1000 == 0:
+                # Gives the flush loop and the sampler a chance to run.
+                await asyncio.sleep(0)
+        handled = time.perf_counter() - started
+        for store in cog.stores.values():
+            await store.flush()
+        drained = time.perf_counter() - started
+        sampler.cancel()
+        cog.flush_task.cancel()
+        for store in cog.stores.values():
+            store.close()
+        size = database_size(Path(directory))
+
+    latencies.sort()
+    return {
+        "users": users,
+        "shape": shape,
+        "events": len(events),
+        "handled_s": round(handled, 3),
+        "drained_s": round(drained, 3),
+        "events_per_s": round(len(events) / drained, 1),
+        "p50_us": round(statistics.median(latencies) * 1e6, 1),
+        "p99_us": round(latencies[int(len(latencies) * 0.99) - 1] * 1e6, 1),
+        "max_queue": max((sample[1] for sample in samples), default=0),
+        "max_buffered": max((sample[2] for sample in samples), default=0),
+        "queue": samples if args.timeline else None,
+        "db_kib": round(size / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingestion benchmark of the Stats cog.")
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--users", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--guilds", type=int, default=1)
+    parser.add_argument("--shapes", nargs="+", choices=SHAPES, default=list(SHAPES))
+    parser.add_argument("--voice-ratio", type=float, default=0.02, help="share of voice events")
+    parser.add_argument("--rate", type=float, default=20000, help="events per second")
+    parser.add_argument("--period", type=float, default=1.0, help="seconds between bursts")
+    parser.add_argument("--sample-every", type=float, default=0.1, help="queue sampling period")
+    parser.add_argument("--timeline", action="store_true", help="include every queue sample")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print JSON lines")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    for users in args.users:
+        for shape in args.shapes:
+            result = loop.run_until_complete(run(args, users, shape))
+            if args.json:
+                print(json.dumps(result))
+                continue
+            print(
+                "{users:>6} users {shape:<6} {events_per_s:>10} ev/s "
+                "p50={p50_us:>7}us p99={p99_us:>8}us queue<={max_queue:<3} "
+                "buffered<={max_buffered:<6} db={db_kib:>9}KiB".format(**result)
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,11 @@ locale.setlocale(locale.LC_ALL, 'fr_FR.utf8')
 
 listener = getattr(commands.Cog, "listener", None)  # red 3.0 backwards compatibility support
 
+# Votes within RENDER_DELAY seconds of each other share one embed edit,
+# and reaction removals are sent at most one per REMOVAL_INTERVAL seconds.
+RENDER_DELAY = 2
+REMOVAL_INTERVAL = 0.25
+
 
 class Poll(commands.Cog):
     """Polls"""
@@ -15,86 +20,184 @@ class Poll(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.config = Config.get_conf(self, 45463543548)
-        self.polls = []
+        self.config.register_global(POLLS=[])
+        # Each poll and each vote is its own record, so a vote only
+        # writes that vote and the counts of its poll.
+        self.config.init_custom("POLL", 1)
+        self.config.register_custom(
+            "POLL",
+            id=None, question=None, colour=None, options={}, labels={}, counts=None, multi=False
+        )
+        self.config.init_custom("POLL_VOTE", 2)
+        self.config.register_custom("POLL_VOTE", choice=None)
+        # Message ID -> poll, the voters of each poll in poll['pollers']
+        self.poll_index = {}
+        # Message ID -> lock held while a vote on the poll is recorded
+        self.poll_locks = {}
+        # Message ID -> pending embed edit of a poll
+        self.renders = {}
+        self.removals = asyncio.Queue()
+        self.removal_task = asyncio.ensure_future(self.remove_reactions())
         asyncio.ensure_future(self.set_polls())
 
+    def cog_unload(self):
+        self.removal_task.cancel()
+        for task in self.renders.values():
+            task.cancel()
+
     async def set_polls(self):
-        self.polls = await self.config.POLLS()
+        await self.migrate_polls()
+        polls = await self.config.custom("POLL").all()
+        votes = await self.config.custom("POLL_VOTE").all()
+        for poll_id, poll in polls.items():
+            poll['pollers'] = {
+                user_id: vote['choice'] for user_id, vote in votes.get(poll_id, {}).items()
+            }
+            self.poll_index[int(poll_id)] = poll
+
+    async def migrate_polls(self):
+        """Moves the polls of the POLLS list, from older versions, to their own records."""
+        legacy = await self.config.POLLS()
+        if not legacy:
+            return
+        for poll in legacy:
+            pollers = poll.pop('pollers')
+            await self.save_poll(poll)
+            await self.config.custom("POLL_VOTE", poll['id']).set({
+                user_id: {"choice": choice}
+                for user_id, choice in pollers.items()
+                if choice not in ('null', ['null'])
+            })
+        await self.config.POLLS.clear()
+
+    async def save_poll(self, poll):
+        await self.config.custom("POLL", poll['id']).set(
+            {key: value for key, value in poll.items() if key != 'pollers'}
+        )
+
+    def add_poll(self, poll):
+        self.poll_index[int(poll['id'])] = poll
 
     async def get_colour(self, channel):
         return await RedBase.get_embed_colour(self.bot, channel)
 
-    async def edit_poll(self, message, poll):
-        polls = []
-        description = []
-        embed = message.embeds[0]
-        unformatted_options = [x.strip() for x in embed.description.split('\n')]
-        options_dict = poll['options']
-        options = []
-        for x in options_dict:
-            options.append(x)
-        for k in options:
-            polls.append(0)
-        if poll["multi"]:
-            for x, y in poll['pollers'].items():
-                for z in y:
-                    if z != 'null':
-                        polls[options.index(z)] += 1
+    @staticmethod
+    def render_poll(poll):
+        """Builds the embed of a poll from its labels and counts."""
+        description = ''.join(
+            '\n {} {} --- {} polls'.format(emoji, poll['labels'][key], poll['counts'][key])
+            for key, emoji in poll['options'].items()
+        )
+        embed = discord.Embed(colour=poll['colour'], title=poll['question'], description=description)
+        if poll['id'] is not None:
+            embed.set_footer(text='Poll ID: {}'.format(poll['id']))
+        return embed
+
+    @staticmethod
+    def migrate_poll(poll, embed):
+        """
+        Adds the question, labels and counts to a poll made before they
+        were stored, from its embed and voters. Only done once per poll.
+        """
+        lines = [x.strip() for x in embed.description.split('\n') if x.strip()]
+        poll['question'] = embed.title
+        poll['colour'] = embed.colour.value
+        poll['labels'] = {}
+        poll['counts'] = {key: 0 for key in poll['options']}
+        for key, line in zip(poll['options'], lines):
+            label = line.rsplit(' --- ', 1)[0]
+            poll['labels'][key] = label.split(' ', 1)[1] if ' ' in label else ''
+        for choice in poll['pollers'].values():
+            for key in (choice if poll['multi'] else [choice]):
+                if key in poll['counts']:
+                    poll['counts'][key] += 1
+
+    @staticmethod
+    def apply_vote(poll, user_id, option):
+        """Records a vote and updates the counts it changes."""
+        pollers = poll['pollers']
+        counts = poll['counts']
+        if poll['multi']:
+            choices = pollers.setdefault(user_id, [])
+            if option in choices:
+                choices.remove(option)
+                counts[option] -= 1
+            else:
+                choices.append(option)
+                counts[option] += 1
         else:
-            for x, y in poll['pollers'].items():
-                if y != 'null':
-                    polls[options.index(y)] += 1
-        for j, poll in enumerate(polls):
-            option = unformatted_options[j]
-            option = option[:-6]
-            option = option.split(' --- ')
-            description += '\n {}'.format(option[0])
-            description += ' --- ' + str(poll) + ' polls'
-        # ['{}: {}'.format(opt_dict[key], tally[key]) ]
-        embed2 = discord.Embed(colour=embed.colour, title=embed.title, description=''.join(description))
-        embed2.set_footer(text=embed.footer.text)
-        await message.edit(embed=embed2)
+            previous = pollers.get(user_id)
+            if previous in counts:
+                counts[previous] -= 1
+            pollers[user_id] = option
+            counts[option] += 1
+
+    def schedule_render(self, channel, poll):
+        """Edits the poll embed in RENDER_DELAY seconds, unless an edit is already planned."""
+        message_id = int(poll['id'])
+        if message_id not in self.renders:
+            self.renders[message_id] = asyncio.ensure_future(self.edit_poll(channel, poll))
+
+    async def edit_poll(self, channel, poll):
+        message_id = int(poll['id'])
+        try:
+            await asyncio.sleep(RENDER_DELAY)
+        finally:
+            del self.renders[message_id]
+        # Votes from now on plan a new edit, this one shows all the previous ones.
+        try:
+            await channel.get_partial_message(message_id).edit(embed=self.render_poll(poll))
+        except discord.HTTPException:
+            pass
+
+    async def remove_reactions(self):
+        """Loop task that removes the vote reactions, one at a time."""
+        while True:
+            channel, message_id, emoji, user_id = await self.removals.get()
+            try:
+                await channel.get_partial_message(message_id).remove_reaction(
+                    emoji, discord.Object(id=user_id)
+                )
+            except discord.HTTPException:
+                pass
+            await asyncio.sleep(REMOVAL_INTERVAL)
 
     @listener()
     async def on_raw_reaction_add(self, payload):
-        poll_message = await self.bot.get_channel(payload.channel_id).fetch_message(payload.message_id)
-        if poll_message.author.id == payload.user_id:
+        # Everything that can be told from the payload is checked before
+        # any request, so reactions on other messages cost nothing.
+        poll = self.poll_index.get(payload.message_id)
+        if poll is None or payload.user_id == self.bot.user.id:
             return
-        if not poll_message.embeds:
+        option = next((x for x, y in poll['options'].items() if y == str(payload.emoji)), None)
+        if option is None:
             return
-        embed = poll_message.embeds[0]
-        try:
-            if not embed.footer.text.startswith('Poll ID:'):
-                return
-        except:
+        channel = self.bot.get_channel(payload.channel_id)
+        if channel is None:
             return
-        for k in range(len(self.polls)):
-            if self.polls[k]['id'] == str(poll_message.id):
-                poll = self.polls[k]
-                index = k
-        pollers = poll['pollers']
-        guild = self.bot.get_guild(payload.guild_id)
-        member = guild.get_member(payload.user_id)
-        for x, y in poll['options'].items():
-            if y == str(payload.emoji):
-                option = x
-                break
-        if poll["multi"]:
-            if str(payload.user_id) in pollers and option in pollers[str(payload.user_id)]:
-                poll['pollers'][str(payload.user_id)].pop(poll['pollers'][str(payload.user_id)].index(option))
-            elif str(payload.user_id) in pollers:
-                poll['pollers'][str(payload.user_id)].append(option)
-            else:
-                poll['pollers'][str(payload.user_id)] = [option]
-        else:
-            if str(payload.user_id) in pollers:
-                poll['pollers'].pop(str(payload.user_id))
-            poll['pollers'][str(payload.user_id)] = option
+        embed = None
+        if poll.get('counts') is None:
+            poll_message = await channel.fetch_message(payload.message_id)
+            if not poll_message.embeds:
+                return
+            embed = poll_message.embeds[0]
+        user_id = str(payload.user_id)
+
+        # Votes on one poll are applied and saved one at a time, so none is
+        # lost between reading and saving. The embed edit and the reaction
+        # removal are queued, and happen outside of the lock.
+        async with self.poll_locks.setdefault(payload.message_id, asyncio.Lock()):
+            if poll.get('counts') is None:
+                self.migrate_poll(poll, embed)
+                await self.save_poll(poll)
+            self.apply_vote(poll, user_id, option)
+            await self.config.custom("POLL_VOTE", poll['id'], user_id).choice.set(
+                poll['pollers'][user_id]
+            )
+            await self.config.custom("POLL", poll['id']).counts.set(poll['counts'])
 
-        self.polls[index] = poll
-        await self.edit_poll(poll_message, poll)
-        await poll_message.remove_reaction(payload.emoji, member)
-        await self.config.POLLS.set(self.polls)
+        self.schedule_render(channel, poll)
+        self.removals.put_nowait((channel, payload.message_id, payload.emoji, payload.user_id))
 
     @commands.command(pass_context=True)
     @commands.guild_only()
@@ -109,32 +212,13 @@ class Poll(commands.Cog):
             return
 
         if len(options) == 2 and ((options[0] == 'Oui' and options[1] == 'Non') or (options[0] == 'oui' and options[1] == 'Non') or (options[0] == 'oui' and options[1] == 'non') or (options[0] == 'Oui' and options[1] == 'non')):
-            reactions = ['✅', '❌']
             emoji = {"oui": "✅", "non": "❌"}
         elif len(options) == 3 and ((options[0] == 'Oui' and options[1] == 'Non' and options[2] == 'Joker') or (options[0] == 'oui' and options[1] == 'Non' and options[2] == 'Joker') or (options[0] == 'oui' and options[1] == 'non' and options[2] == 'Joker') or (options[0] == 'oui' and options[1] == 'non' and options[2] == 'joker') or (options[0] == 'Oui' and options[1] == 'non' and options[2] == 'joker') or (options[0] == 'Oui' and options[1] == 'Non' and options[2] == 'joker')):
-            reactions = ['✅', '❌', '🃏']
             emoji = {"oui": "✅", "non": "❌", "joker": "🃏"}
 
         else:
-            reactions = ['1⃣', '2⃣', '3⃣', '4⃣', '5⃣', '6⃣', '7⃣', '8⃣', '9⃣', '🔟']
             emoji = {"un": "1⃣", "deux": "2⃣", "trois": "3⃣", "quatre": "4⃣", "cinq": "5⃣", "six": "6⃣", "sept": "7⃣", "huit": "8⃣", "neuf": "9⃣", "dix": "🔟"}
-        emojis = {}
-        description = []
-        polls = []
-        for x, option in enumerate(options):
-            emojis[list(emoji.keys())[x]] = emoji[list(emoji.keys())[x]]
-            polls.append(0)
-            description += '\n {} {}'.format(reactions[x], option)
-            description += ' --- ' + str(polls[x]) + ' polls'
-        embed = discord.Embed(colour=await self.get_colour(ctx.message.channel), title=question, description=''.join(description))
-        react_message = await ctx.send(embed=embed)
-        for reaction in reactions[:len(options)]:
-            await react_message.add_reaction(reaction)
-        embed.set_footer(text='Poll ID: {}'.format(react_message.id))
-        await react_message.edit(embed=embed)
-        pollers = {f"{react_message.author.id}": "null"}
-        self.polls.append({"id": f"{react_message.id}", "options": emojis, "pollers": pollers, "multi": False})
-        await self.config.POLLS.set(self.polls)
+        await self.start_poll(ctx, question, options, emoji, multi=False)
     
     @commands.command(pass_context=True)
     @commands.guild_only()
@@ -149,54 +233,56 @@ class Poll(commands.Cog):
             return
 
         if len(options) == 2 and ((options[0] == 'Oui' and options[1] == 'Non') or (options[0] == 'oui' and options[1] == 'Non') or (options[0] == 'oui' and options[1] == 'non') or (options[0] == 'Oui' and options[1] == 'non')):
-            reactions = ['✅', '❌']
             emoji = {"oui": "✅", "non": "❌"}
         elif len(options) == 3 and ((options[0] == 'Oui' and options[1] == 'Non' and options[2] == 'Joker') or (options[0] == 'oui' and options[1] == 'Non' and options[2] == 'Joker') or (options[0] == 'oui' and options[1] == 'non' and options[2] == 'Joker') or (options[0] == 'oui' and options[1] == 'non' and options[2] == 'joker') or (options[0] == 'Oui' and options[1] == 'non' and options[2] == 'joker') or (options[0] == 'Oui' and options[1] == 'Non' and options[2] == 'joker')):
-            reactions = ['✅', '❌', '🃏']
             emoji = {"oui": "✅", "non": "❌", "joker": "🃏"}
 
         else:
-            reactions = ['1⃣', '2⃣', '3⃣', '4⃣', '5⃣', '6⃣', '7⃣', '8⃣', '9⃣', '🔟']
             emoji = {"un": "1⃣", "deux": "2⃣", "trois": "3⃣", "quatre": "4⃣", "cinq": "5⃣", "six": "6⃣", "sept": "7⃣", "huit": "8⃣", "neuf": "9⃣", "dix": "🔟"}
-        emojis = {}
-        description = []
-        polls = []
-        for x, option in enumerate(options):
-            emojis[list(emoji.keys())[x]] = emoji[list(emoji.keys())[x]]
-            polls.append(0)
-            description += '\n {} {}'.format(reactions[x], option)
-            description += ' --- ' + str(polls[x]) + ' polls'
-        embed = discord.Embed(colour=await self.get_colour(ctx.message.channel), title=question, description=''.join(description))
-        react_message = await ctx.send(embed=embed)
-        for reaction in reactions[:len(options)]:
-            await react_message.add_reaction(reaction)
-        embed.set_footer(text='Poll ID: {}'.format(react_message.id))
-        await react_message.edit(embed=embed)
-        pollers = {f"{react_message.author.id}": ["null"]}
-        self.polls.append({"id": f"{react_message.id}", "options": emojis, "pollers": pollers, "multi": True})
-        await self.config.POLLS.set(self.polls)
+        await self.start_poll(ctx, question, options, emoji, multi=True)
+
+    async def start_poll(self, ctx, question, options, emoji, multi):
+        """Sends a poll with one emoji of the emoji dict per option, and saves it."""
+        keys = list(emoji)[:len(options)]
+        poll = {
+            "id": None,
+            "question": question,
+            "colour": (await self.get_colour(ctx.message.channel)).value,
+            "options": {key: emoji[key] for key in keys},
+            "labels": dict(zip(keys, options)),
+            "counts": {key: 0 for key in keys},
+            "pollers": {},
+            "multi": multi,
+        }
+        react_message = await ctx.send(embed=self.render_poll(poll))
+        for key in keys:
+            await react_message.add_reaction(emoji[key])
+        poll['id'] = f"{react_message.id}"
+        await react_message.edit(embed=self.render_poll(poll))
+        self.add_poll(poll)
+        await self.save_poll(poll)
 
     @commands.command(pass_context=True)
     @checks.is_owner()
     async def poll_result(self, ctx, id: str):
-        for poll in self.polls:
-            if poll["id"] == id:
-                pollers = poll['pollers']
-                del pollers[str(self.bot.user.id)]
-                embed = discord.Embed(colour=await self.get_colour(ctx.message.channel), title="Résultats du vote (Message 1)")
-                for index, (x, y) in enumerate(pollers.items()):
-                    if index%20 == 0 and index != 0:
-                        await ctx.send(embed=embed)
-                        embed = discord.Embed(colour=await self.get_colour(ctx.message.channel), title="Résultats du vote (Message {})".format((index//20)+1))
-                    embed.add_field(name="Vote", value=f"<@{x}> --- {y}", inline=False)
+        poll = self.poll_index.get(int(id)) if id.isdigit() else None
+        if poll is None:
+            return
+        pollers = {x: y for x, y in poll['pollers'].items() if y not in ('null', ['null'])}
+        embed = discord.Embed(colour=await self.get_colour(ctx.message.channel), title="Résultats du vote (Message 1)")
+        for index, (x, y) in enumerate(pollers.items()):
+            if index%20 == 0 and index != 0:
                 await ctx.send(embed=embed)
-                return
+                embed = discord.Embed(colour=await self.get_colour(ctx.message.channel), title="Résultats du vote (Message {})".format((index//20)+1))
+            embed.add_field(name="Vote", value=f"<@{x}> --- {y}", inline=False)
+        await ctx.send(embed=embed)
 
     @commands.command(pass_context=True)
     @checks.is_owner()
     async def poll_clean(self, ctx):
-        self.polls = []
-        await self.config.POLLS.set(self.polls)
+        self.poll_index = {}
+        await self.config.custom("POLL").clear()
+        await self.config.custom("POLL_VOTE").clear()
         embed = discord.Embed(colour=await self.get_colour(ctx.message.channel), title="Polls cleaned")
         await ctx.send(embed=embed)
 
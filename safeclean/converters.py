@@ -1,12 +1,35 @@
+import discord
 from redbot.core.commands import Converter, BadArgument
 from redbot.core.i18n import Translator
 
 _ = Translator("Cleanup", __file__)
 
 
+class MessageBound(discord.Object):
+    """
+    A message ID used as a ``before``/``after`` bound for history.
+
+    Nothing is fetched when it is parsed. As an upper bound, the message's
+    existence is checked against the first history page instead.
+    """
+
+
+class MessageNotFound(Exception):
+    """Raised when the history shows that a bound message doesn't exist."""
+
+    def __init__(self, message_id: int):
+        super().__init__(message_id)
+        self.message_id = message_id
+
+
 class RawMessageIds(Converter):
-    async def convert(self, ctx, argument):
+    async def convert(self, ctx, argument) -> MessageBound:
         if argument.isnumeric() and len(argument) >= 17:
-            return int(argument)
+            message_id = int(argument)
+            # A message of this channel can't be older than the channel
+            # or newer than the command invoking us.
+            if not ctx.channel.id <= message_id < ctx.message.id:
+                raise BadArgument(_("Message not found."))
+            return MessageBound(id=message_id)
 
         raise BadArgument(_("{} doesn't look like a valid message ID.").format(argument))
@@ -0,0 +1,126 @@
+from collections import OrderedDict
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+import discord
+
+# Messages kept per channel, and characters of content kept per message.
+INDEX_SIZE = 500
+CONTENT_PREFIX = 128
+
+
+class CachedMessage(NamedTuple):
+    """
+    The little the index keeps about a message.
+
+    It quacks enough like a `discord.Message` for cleanup checks:
+    ``id``, ``author.id``, ``pinned`` and ``content``. Only the first
+    characters of the content are kept, ``truncated`` tells when some
+    are missing.
+    """
+
+    id: int
+    author_id: int
+    pinned: bool
+    content: str
+    truncated: bool
+
+    @property
+    def author(self) -> discord.Object:
+        return discord.Object(id=self.author_id)
+
+    @classmethod
+    def from_message(cls, message: discord.Message) -> "CachedMessage":
+        content = message.content
+        return cls(
+            message.id,
+            message.author.id,
+            message.pinned,
+            content[:CONTENT_PREFIX],
+            len(content) > CONTENT_PREFIX,
+        )
+
+
+class ChannelIndex:
+    """
+    A ring buffer of the most recent messages of a channel.
+
+    Every message newer than ``floor`` that still exists is in the
+    buffer: the index starts covering a channel at the first message it
+    sees, and ``floor`` moves up as old messages are evicted.
+    """
+
+    __slots__ = ("messages", "floor", "size")
+
+    def __init__(self, first_id: int, size: int = INDEX_SIZE):
+        self.messages: "OrderedDict[int, CachedMessage]" = OrderedDict()
+        self.floor = first_id - 1
+        self.size = size
+
+    def __contains__(self, message_id: int) -> bool:
+        return message_id in self.messages
+
+    def add(self, message: discord.Message):
+        self.messages[message.id] = CachedMessage.from_message(message)
+        while len(self.messages) > self.size:
+            evicted, _ = self.messages.popitem(last=False)
+            self.floor = max(self.floor, evicted)
+
+    def remove(self, message_id: int):
+        self.messages.pop(message_id, None)
+
+    def edit(self, message_id: int, data: dict):
+        """Applies the fields of a raw message edit that the index keeps."""
+        record = self.messages.get(message_id)
+        if record is None:
+            return
+        if "content" in data:
+            content = data["content"]
+            record = record._replace(
+                content=content[:CONTENT_PREFIX], truncated=len(content) > CONTENT_PREFIX
+            )
+        if "pinned" in data:
+            record = record._replace(pinned=data["pinned"])
+        self.messages[message_id] = record
+
+    def newest_first(self, before: Optional[int] = None) -> List[CachedMessage]:
+        """Returns a snapshot of the messages older than ``before``, newest first."""
+        return sorted(
+            (record for record in self.messages.values() if before is None or record.id < before),
+            key=lambda record: record.id,
+            reverse=True,
+        )
+
+
+class MessageIndex:
+    """The recent messages of every guild channel, filled from gateway events."""
+
+    def __init__(self, size: int = INDEX_SIZE):
+        self.size = size
+        self.channels: Dict[int, ChannelIndex] = {}
+
+    def get(self, channel_id: int) -> Optional[ChannelIndex]:
+        return self.channels.get(channel_id)
+
+    def add(self, message: discord.Message):
+        channel = self.channels.get(message.channel.id)
+        if channel is None:
+            channel = self.channels[message.channel.id] = ChannelIndex(message.id, self.size)
+        channel.add(message)
+
+    def remove(self, channel_id: int, message_ids: Iterable[int]):
+        channel = self.channels.get(channel_id)
+        if channel is not None:
+            for message_id in message_ids:
+                channel.remove(message_id)
+
+    def edit(self, channel_id: int, message_id: int, data: dict):
+        channel = self.channels.get(channel_id)
+        if channel is not None:
+            channel.edit(message_id, data)
+
+    def forget(self, channel_id: int = None):
+        """Drops a channel, or every channel, when events may have been missed."""
+        if channel_id is None:
+            self.channels.clear()
+        else:
+            self.channels.pop(channel_id, None)
@@ -0,0 +1,114 @@
+import asyncio
+import time
+from datetime import timedelta
+from typing import Dict, Iterable, Optional
+
+import discord
+
+PENDING = "pending"
+RUNNING = "running"
+FINISHED = "finished"
+CANCELLED = "cancelled"
+FAILED = "failed"
+
+
+def channel_state(
+    *,
+    number: Optional[int] = None,
+    before: Optional[discord.abc.Snowflake] = None,
+    after: Optional[discord.abc.Snowflake] = None,
+    verify_before: bool = False,
+) -> dict:
+    """
+    Builds the saved state of one channel of a job.
+
+    ``before`` is moved to the oldest handled message after every batch,
+    which is where a restarted job continues from.
+    """
+    return {
+        "number": number,
+        "before": before.id if before is not None else None,
+        "after": after.id if after is not None else None,
+        "verify_before": verify_before,
+        "matched": 0,
+        "deleted": 0,
+        "done": False,
+    }
+
+
+class PurgeJob:
+    """
+    A cleanup running in the background.
+
+    ``data`` holds everything needed to run the job again from its last
+    checkpoint, and is what gets saved to the config:
+
+    - ``filter``: which messages match, see `SafeClean.build_check`
+    - ``channels``: the state of each channel, see `channel_state`
+    - ``include``: extra message IDs to delete, usually the command
+    - ``report``: whether the result is sent to the invoking channel
+    - ``description``: what is being deleted, for the audit log
+    - the guild, invoking channel, author and progress message IDs
+    """
+
+    def __init__(self, job_id: int, data: dict):
+        self.id = job_id
+        self.data = data
+        self.status = PENDING
+        self.error: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        self.cancelled_by: Optional[int] = None
+        self.started = time.monotonic()
+        self.ended: Optional[float] = None
+
+    @classmethod
+    def new(
+        cls,
+        job_id: int,
+        ctx,
+        *,
+        filter: dict,
+        channels: Dict[int, dict],
+        description: str,
+        delete_pinned: bool = False,
+        include: Iterable[discord.Message] = (),
+        report: bool = True,
+        progress: Optional[discord.Message] = None,
+    ) -> "PurgeJob":
+        return cls(
+            job_id,
+            {
+                "guild": ctx.guild.id if ctx.guild else None,
+                "channel": ctx.channel.id,
+                "author": ctx.author.id,
+                "author_name": str(ctx.author),
+                "progress": progress.id if progress is not None else None,
+                "description": description,
+                "filter": filter,
+                "delete_pinned": delete_pinned,
+                "include": [m.id for m in include],
+                "report": report,
+                "channels": {str(channel_id): state for channel_id, state in channels.items()},
+            },
+        )
+
+    @property
+    def channels(self) -> Dict[str, dict]:
+        return self.data["channels"]
+
+    @property
+    def deleted(self) -> int:
+        return sum(state["deleted"] for state in self.channels.values())
+
+    @property
+    def channels_done(self) -> int:
+        return sum(1 for state in self.channels.values() if state["done"])
+
+    @property
+    def elapsed(self) -> timedelta:
+        end = self.ended if self.ended is not None else time.monotonic()
+        return timedelta(seconds=round(end - self.started))
+
+    @property
+    def active(self) -> bool:
+        return self.status in (PENDING, RUNNING)
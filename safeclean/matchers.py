@@ -0,0 +1,159 @@
+import re
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional
+
+_GLOBAL_FLAGS = re.compile(r"^\(\?([aiLmsux]+)\)")
+
+
+def split_patterns(argument: str, regexes: bool = True) -> List[str]:
+    """
+    Splits a command argument into patterns separated by ``|``.
+
+    ``\\|`` stands for a ``|`` that is part of a pattern. With
+    ``regexes``, patterns wrapped in r( and ) are regexes and may contain
+    ``|`` themselves; the split only happens outside of their parentheses.
+    """
+    patterns = []
+    current = []
+    depth = 0
+    escaped = False
+    for char in argument:
+        if depth:
+            current.append(char)
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == "(":
+                depth += 1
+            elif char == ")":
+                depth -= 1
+        elif char == "|":
+            if current and current[-1] == "\\":
+                current[-1] = char
+                continue
+            patterns.append("".join(current))
+            current = []
+        else:
+            current.append(char)
+            if regexes and char == "(" and len(current) == 2 and current[0] == "r":
+                depth = 1
+    patterns.append("".join(current))
+    return patterns
+
+
+def _scoped_regex(pattern: str) -> str:
+    """Turns leading global flags such as (?si) into scoped ones so patterns can be joined."""
+    flags = _GLOBAL_FLAGS.match(pattern)
+    if flags:
+        return "(?{}:{})".format(flags.group(1), pattern[flags.end() :])
+    return "(?:{})".format(pattern)
+
+
+class ContentMatcher:
+    """
+    Matches message content against many keywords and regexes at once.
+
+    Keywords are substring tests, patterns wrapped in r( and ) are regexes
+    matched at the start of the content, unless ``regexes`` is False.
+    Each kind is compiled into a
+    single alternation, so a message is tested in one pass however many
+    patterns there are. Without any pattern, everything matches.
+    """
+
+    __slots__ = ("_keywords", "_regex")
+
+    def __init__(self, patterns: Iterable[str], regexes: bool = True):
+        keywords = set()
+        compiled = []
+        for pattern in patterns:
+            if regexes and pattern.startswith("r(") and pattern.endswith(")"):
+                compiled.append(_scoped_regex(pattern[2:-1]))
+            elif pattern:
+                keywords.add(pattern)
+        self._keywords = (
+            re.compile("|".join(map(re.escape, sorted(keywords, key=len, reverse=True))))
+            if keywords
+            else None
+        )
+        self._regex = re.compile("|".join(compiled)) if compiled else None
+
+    @classmethod
+    def from_argument(cls, argument: Optional[str], regexes: bool = True) -> "ContentMatcher":
+        """Builds a matcher from a ``|``-separated command argument."""
+        return cls(split_patterns(argument, regexes) if argument else (), regexes)
+
+    def settled(self, start: str) -> bool:
+        """
+        Tells whether the result for a content starting with ``start`` is
+        the same whatever the rest of the content is.
+
+        A keyword found in the start stays found; a regex, or a keyword
+        that isn't found yet, depends on the rest.
+        """
+        if self._keywords is not None and self._keywords.search(start):
+            return True
+        return self._keywords is None and self._regex is None
+
+    def __call__(self, content: str) -> bool:
+        if self._keywords is None and self._regex is None:
+            return True
+        return bool(
+            (self._keywords is not None and self._keywords.search(content))
+            or (self._regex is not None and self._regex.match(content))
+        )
+
+
+class PrefixTrie:
+    """Finds the prefixes a message starts with, reading its content once."""
+
+    __slots__ = ("_root",)
+
+    def __init__(self, prefixes: Iterable[str]):
+        self._root: Dict[Optional[str], dict] = {}
+        for prefix in prefixes:
+            if not prefix:
+                # In case some idiot sets a null prefix
+                continue
+            node = self._root
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node[None] = prefix
+
+    def matches(self, content: str) -> Iterator[str]:
+        """Yields every prefix ``content`` starts with, shortest first."""
+        node = self._root
+        for char in content:
+            node = node.get(char)
+            if node is None:
+                return
+            if None in node:
+                yield node[None]
+
+
+class CommandMatcher:
+    """Tells whether a message invokes a command, an alias or a custom command."""
+
+    __slots__ = ("_prefixes", "_names")
+
+    def __init__(self, prefixes: Iterable[str], names: Iterable[str]):
+        self._prefixes = PrefixTrie(prefixes)
+        self._names: FrozenSet[str] = frozenset(names)
+
+    def __call__(self, content: str) -> bool:
+        for prefix in self._prefixes.matches(content):
+            if content[len(prefix) :].partition(" ")[0] in self._names:
+                return True
+        return False
+
+    def settled(self, start: str) -> bool:
+        """
+        Tells whether the result for a content starting with ``start`` is
+        the same whatever the rest of the content is.
+
+        Only the prefix and the first word matter: once a space follows
+        them, the rest of the content can't change the result.
+        """
+        for prefix in self._prefixes.matches(start):
+            if not start[len(prefix) :].partition(" ")[1]:
+                return False
+        return True
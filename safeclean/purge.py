@@ -0,0 +1,252 @@
+import asyncio
+import bisect
+import logging
+import math
+import time
+from datetime import timedelta
+from typing import AsyncIterator, Awaitable, Callable, Iterable, List, Optional, Tuple
+
+import discord
+
+log = logging.getLogger("red.safeclean")
+
+BULK_DELETE_LIMIT = 100
+BULK_DELETE_MAX_AGE = timedelta(days=14)
+# Messages this close to the bulk delete limit are deleted one by one,
+# so they can't age out between sorting and the API call.
+BULK_DELETE_MARGIN = timedelta(minutes=5)
+SINGLE_DELETE_WORKERS = 3
+# Rough cost of each API call once its rate limit bucket is saturated,
+# used to project how long a cleanup will take.
+HISTORY_PAGE_SECONDS = 0.5
+BULK_DELETE_SECONDS = 1.0
+SINGLE_DELETE_SECONDS = 1.2
+
+
+class Batch(list):
+    """
+    Messages to delete, and how far the scan that found them has gone.
+
+    Every message newer than ``cursor`` has been examined by the time the
+    batch is handed over, so a job can continue from there. A batch may
+    be empty and only move the cursor. ``fetched`` counts the messages
+    read from the history API since the previous batch, as opposed to
+    the local index.
+    """
+
+    __slots__ = ("cursor", "fetched")
+
+    def __init__(self, messages: Iterable[discord.abc.Snowflake] = (), cursor: int = None):
+        super().__init__(messages)
+        self.cursor = cursor
+        self.fetched = 0
+
+
+def bulk_delete_cutoff(now: float = None) -> int:
+    """Returns the oldest snowflake Discord still accepts for bulk deletion."""
+    if now is None:
+        now = time.time()
+    max_age = (BULK_DELETE_MAX_AGE - BULK_DELETE_MARGIN).total_seconds()
+    return int((now - max_age) * 1000 - discord.utils.DISCORD_EPOCH) << 22
+
+
+def split_by_age(ids: Iterable[int], cutoff: int = None) -> Tuple[List[int], List[int]]:
+    """
+    Splits message IDs on the timestamp encoded in their snowflake.
+
+    Returns the IDs that can be bulk deleted and the ones that are too old
+    for it, both sorted newest first. No message has to be fetched.
+    """
+    if cutoff is None:
+        cutoff = bulk_delete_cutoff()
+    snowflakes = sorted(set(ids))
+    split = bisect.bisect_left(snowflakes, cutoff)
+    return snowflakes[split:][::-1], snowflakes[:split][::-1]
+
+
+async def bulk_delete(channel: discord.TextChannel, ids: List[int]) -> int:
+    """Bulk-deletes message IDs younger than 14 days in chunks of 100."""
+    deleted = 0
+    for start in range(0, len(ids), BULK_DELETE_LIMIT):
+        chunk = ids[start : start + BULK_DELETE_LIMIT]
+        try:
+            await channel.delete_messages([discord.Object(id=message_id) for message_id in chunk])
+        except discord.NotFound:
+            # A lone message goes through the single delete endpoint,
+            # which fails if it's already gone.
+            continue
+        deleted += len(chunk)
+    return deleted
+
+
+async def single_delete(
+    channel: discord.TextChannel, ids: List[int], workers: int = SINGLE_DELETE_WORKERS
+) -> int:
+    """
+    Deletes message IDs one by one with a small pool of workers.
+
+    discord.py already waits on the channel's rate limit bucket; if a 429
+    still comes through, the worker sleeps for the advertised delay and
+    puts the message back in the queue.
+    """
+    queue = asyncio.Queue()
+    for message_id in ids:
+        queue.put_nowait(message_id)
+    deleted = 0
+
+    async def worker():
+        nonlocal deleted
+        while True:
+            try:
+                message_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                await channel.delete_messages([discord.Object(id=message_id)])
+            except discord.NotFound:
+                continue
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    raise
+                retry_after = float(e.response.headers.get("Retry-After", 1))
+                await asyncio.sleep(retry_after)
+                queue.put_nowait(message_id)
+            else:
+                deleted += 1
+
+    tasks = [asyncio.ensure_future(worker()) for _ in range(min(workers, len(ids)))]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # Stop the other workers before the error reaches the job.
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return deleted
+
+
+async def delete_message_ids(channel: discord.TextChannel, ids: Iterable[int]) -> int:
+    """
+    Deletes the given message IDs from a channel.
+
+    The IDs are routed on their snowflake timestamp: messages younger than
+    14 days are bulk-deleted in chunks of 100, older ones go through
+    the single-delete worker pool.
+
+    Returns the number of messages deleted.
+    """
+    young, old = split_by_age(ids)
+    started = time.monotonic()
+    deleted = await bulk_delete(channel, young)
+    if old:
+        deleted += await single_delete(channel, old)
+    elapsed = time.monotonic() - started
+    log.debug(
+        "Deleted %s messages (%s bulk, %s single) in channel %s in %.2fs (%.1f messages/s).",
+        deleted,
+        len(young),
+        len(old),
+        channel.id,
+        elapsed,
+        deleted / elapsed if elapsed else 0.0,
+    )
+    return deleted
+
+
+async def delete_stream(
+    channel: discord.TextChannel,
+    batches: AsyncIterator[Batch],
+    *,
+    include: Iterable[int] = (),
+    checkpoint: Optional[Callable[[int, int, int], Awaitable[None]]] = None,
+    max_pending: int = 2,
+) -> int:
+    """
+    Deletes batches of messages while the next ones are being fetched.
+
+    At most ``max_pending`` batches wait in the queue, so memory stays
+    flat however long the range is, and the first deletion happens as
+    soon as the first page has been filtered.
+
+    After each batch, ``checkpoint`` is awaited with the cursor of the
+    batch, the number of messages it held and the number deleted. Every
+    message newer than the cursor has been handled by then.
+
+    Returns the number of messages deleted.
+    """
+    queue = asyncio.Queue(maxsize=max_pending)
+
+    async def produce():
+        try:
+            async for batch in batches:
+                await queue.put((batch.cursor, [message.id for message in batch]))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await queue.put(None)
+            raise
+        await queue.put(None)
+
+    producer = asyncio.ensure_future(produce())
+    pending = list(include)
+    deleted = 0
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            cursor, ids = item
+            batch_deleted = 0
+            if pending or ids:
+                batch_deleted = await delete_message_ids(channel, pending + ids)
+            deleted += batch_deleted
+            pending = []
+            if checkpoint is not None and cursor is not None:
+                await checkpoint(cursor, len(ids), batch_deleted)
+    except BaseException:
+        producer.cancel()
+        raise
+    await producer
+    if pending:
+        deleted += await delete_message_ids(channel, pending)
+    return deleted
+
+
+class DryRunFinished(Exception):
+    """Raised once a cleanup has been estimated instead of run."""
+
+
+class DeletionEstimate:
+    """Counts what a cleanup would delete and the API calls it would make."""
+
+    def __init__(self):
+        self.channels = 0
+        self.concurrency = 1
+        self.pages = 0
+        self.bulk = 0
+        self.single = 0
+        self.bulk_calls = 0
+
+    @property
+    def matched(self) -> int:
+        return self.bulk + self.single
+
+    def add_channel(self, fetched: int, ids: Iterable[int]):
+        """Records the messages read from a channel's history and the IDs that matched."""
+        young, old = split_by_age(ids)
+        self.channels += 1
+        self.pages += math.ceil(fetched / BULK_DELETE_LIMIT)
+        self.bulk += len(young)
+        self.single += len(old)
+        self.bulk_calls += math.ceil(len(young) / BULK_DELETE_LIMIT)
+
+    @property
+    def duration(self) -> timedelta:
+        """Projected wall time, once the history has been read again for deletion."""
+        seconds = (
+            self.pages * HISTORY_PAGE_SECONDS
+            + self.bulk_calls * BULK_DELETE_SECONDS
+            + self.single * SINGLE_DELETE_SECONDS
+        )
+        return timedelta(seconds=round(seconds / max(1, min(self.concurrency, self.channels))))
@@ -1,22 +1,47 @@
 import logging
-import re
+import time
+from copy import copy
 from datetime import datetime, timedelta
-from typing import Union, List, Callable, Set
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 import asyncio
 
 import discord
 
-from redbot.core import checks, commands
+from redbot.core import Config, checks, commands
 from redbot.core.bot import Red
 from redbot.core.i18n import Translator, cog_i18n
-from redbot.core.utils.mod import slow_deletion, mass_purge
+from redbot.core.utils.chat_formatting import box, pagify
 from redbot.core.utils.predicates import MessagePredicate
-from .converters import RawMessageIds
+from .converters import MessageBound, MessageNotFound, RawMessageIds
+from .index import MessageIndex
+from .jobs import CANCELLED, FAILED, FINISHED, PENDING, RUNNING, PurgeJob, channel_state
+from .matchers import CommandMatcher, ContentMatcher
+from .purge import BULK_DELETE_LIMIT, Batch, DeletionEstimate, DryRunFinished, delete_stream
 
 _ = Translator("SafeClean", __file__)
 
 log = logging.getLogger("red.safeclean")
 
+# How many finished jobs `safeclean jobs` keeps showing.
+MAX_FINISHED_JOBS = 20
+# Pages of 100 messages a partial batch is held for before it is deleted,
+# so that sparse cleanups still move their checkpoint regularly.
+CHECKPOINT_PAGES = 10
+
+default_global = {"jobs": {}, "next_job_id": 1}
+default_guild = {"channel_concurrency": 4}
+
 
 @cog_i18n(_)
 class SafeClean(commands.Cog):
@@ -25,6 +50,13 @@ class SafeClean(commands.Cog):
     def __init__(self, bot: Red):
         super().__init__()
         self.bot = bot
+        self.config = Config.get_conf(self, 8434953254)
+        self.config.register_global(**default_global)
+        self.config.register_guild(**default_guild)
+        self.jobs: Dict[int, PurgeJob] = {}
+        self.index = MessageIndex()
+        self._job_id_lock = asyncio.Lock()
+        self._resume_task = self.bot.loop.create_task(self.resume_jobs())
 
     @staticmethod
     async def check_100_plus(ctx: commands.Context, number: int) -> bool:
@@ -55,25 +87,43 @@ class SafeClean(commands.Cog):
             await ctx.send(_("Cancelled."))
             return False
 
-    @staticmethod
-    async def get_messages_for_deletion(
+    async def iter_messages_for_deletion(
+        self,
         *,
         channel: discord.TextChannel,
         number: int = None,
         check: Callable[[discord.Message], bool] = lambda x: True,
-        before: Union[discord.Message, datetime] = None,
-        after: Union[discord.Message, datetime] = None,
+        before: Union[discord.abc.Snowflake, datetime] = None,
+        after: Union[discord.abc.Snowflake, datetime] = None,
         delete_pinned: bool = False,
-    ) -> List[discord.Message]:
+        settled: Callable[[discord.Message], bool] = lambda x: False,
+    ) -> AsyncIterator[Batch]:
         """
-        Gets a list of messages meeting the requirements to be deleted.
+        Yields the messages meeting the requirements to be deleted, in
+        batches of up to 100. A batch is also handed over after every page
+        of 100 messages examined, even empty, or after `CHECKPOINT_PAGES`
+        pages when it holds messages, so its cursor keeps the job's
+        checkpoint close to the scan.
         Generally, the requirements are:
         - We don't have the number of messages to be deleted already
         - The message passes a provided check (if no check is provided,
           this is automatically true)
-        - The message is less than 14 days old
         - The message is not pinned
 
+        Messages older than 14 days are collected as well; the deletion
+        engine routes them to single deletes based on their snowflake.
+
+        Recent messages are read from the local message index when it
+        covers them, as `CachedMessage` objects; the history API is only
+        read for the older part of the range. When the content of a
+        message was truncated in the index, ``settled`` tells whether the
+        verdict of the check on what is left is final; if not, the history
+        API is read from that message on, whether it matched or not.
+
+        A `MessageBound` passed as before is not fetched: the history
+        starts right at it instead, and `MessageNotFound` is raised if
+        the first message returned isn't the bound itself.
+
         Warning: Due to the way the API hands messages back in chunks,
         passing after and a number together is not advisable.
         If you need to accomplish this, you should filter messages on
@@ -91,22 +141,590 @@ class SafeClean(commands.Cog):
                 after = after.created_at
             after = after
 
-        collected = []
+        bound = None
+        if isinstance(before, MessageBound):
+            bound = before.id
+            before = discord.Object(id=bound + 1)
+
+        batch = Batch()
+        collected = 0
+        examined = 0
+        pages = 0
+
+        def hand_over() -> bool:
+            """Counts an examined message and tells whether the batch is due."""
+            nonlocal examined, pages
+            examined += 1
+            due = len(batch) == BULK_DELETE_LIMIT
+            if examined % BULK_DELETE_LIMIT == 0:
+                # An empty batch only moves the checkpoint past the page.
+                pages += 1
+                due = due or not batch or pages >= CHECKPOINT_PAGES
+            if due:
+                pages = 0
+            return due
+
+        index = self.index.get(channel.id)
+        if isinstance(before, datetime) or isinstance(after, datetime):
+            index = None
+        if index is not None:
+            before_id = before.id if before is not None else None
+            after_id = after.id if after is not None else 0
+            floor = index.floor
+            if bound is not None and bound > floor:
+                # The index knows every message after its floor.
+                if bound not in index:
+                    raise MessageNotFound(bound)
+                before_id = bound
+                before = discord.Object(id=bound)
+                bound = None
+            if before_id is None or before_id - 1 > floor:
+                # Where the history API has to take over, if anywhere.
+                resume = floor + 1 if after_id < floor else None
+                for record in index.newest_first(before_id):
+                    if record.id <= after_id:
+                        resume = None
+                        break
+                    if (
+                        record.truncated
+                        and (delete_pinned or not record.pinned)
+                        and not settled(record)
+                    ):
+                        # The end of the content may change the verdict.
+                        resume = record.id + 1
+                        break
+                    if message_filter(record):
+                        batch.append(record)
+                        collected += 1
+                    batch.cursor = record.id
+                    if number and number <= collected:
+                        resume = None
+                        break
+                    if hand_over():
+                        yield batch
+                        batch = Batch()
+                if resume is None:
+                    if batch:
+                        yield batch
+                    return
+                before = discord.Object(id=resume)
+
         async for message in channel.history(
             limit=None, before=before, after=after, oldest_first=False
         ):
+            batch.fetched += 1
+
+            if bound is not None:
+                if message.id != bound:
+                    raise MessageNotFound(bound)
+                bound = None
+                continue
 
             if message_filter(message):
-                collected.append(message)
-                if number and number <= len(collected):
-                    break
+                batch.append(message)
+                collected += 1
+            batch.cursor = message.id
+            if number and number <= collected:
+                break
+            if hand_over():
+                yield batch
+                batch = Batch()
+
+        if bound is not None:
+            raise MessageNotFound(bound)
+
+        if batch or batch.fetched:
+            yield batch
+
+    async def get_messages_for_deletion(self, **kwargs) -> List[discord.Message]:
+        """
+        Gets a list of messages meeting the requirements to be deleted.
 
+        Takes the same arguments as `iter_messages_for_deletion`.
+        """
+        collected = []
+        async for batch in self.iter_messages_for_deletion(**kwargs):
+            collected.extend(batch)
         return collected
 
+    async def delete_messages_for_deletion(
+        self,
+        *,
+        include: Iterable[discord.abc.Snowflake] = (),
+        checkpoint: Callable[[int, int, int], Awaitable[None]] = None,
+        **kwargs
+    ) -> int:
+        """
+        Deletes the messages meeting the requirements to be deleted.
+
+        Each batch is deleted while the next history page is fetched,
+        so memory stays flat on unbounded ranges. Messages passed in
+        ``include`` (usually the command message) are deleted with the
+        first batch, and ``checkpoint`` is awaited after each batch
+        (see `delete_stream`).
+
+        Takes the same arguments as `iter_messages_for_deletion` and
+        returns the number of messages deleted.
+        """
+        return await delete_stream(
+            kwargs["channel"],
+            self.iter_messages_for_deletion(**kwargs),
+            include=(m.id for m in include),
+            checkpoint=checkpoint,
+        )
+
+    @staticmethod
+    async def resolve_user(
+        ctx: commands.Context, user: str
+    ) -> Tuple[Optional[discord.Member], int]:
+        """Resolves a member mention, name or raw ID into a member (if any) and an ID."""
+        member = None
+        try:
+            member = await commands.MemberConverter().convert(ctx, user)
+        except commands.BadArgument:
+            try:
+                _id = int(user)
+            except ValueError:
+                raise commands.BadArgument()
+        else:
+            _id = member.id
+        return member, _id
+
+    async def message_exists(self, channel: discord.TextChannel, message_id: int) -> bool:
+        """
+        Tells whether a message of a channel still exists, without fetching it.
+
+        The local index answers for the messages it covers; otherwise a
+        single history page starting right at the ID is read.
+        """
+        index = self.index.get(channel.id)
+        if index is not None and message_id > index.floor:
+            return message_id in index
+        async for message in channel.history(
+            limit=1, after=discord.Object(id=message_id - 1), oldest_first=True
+        ):
+            return message.id == message_id
+        return False
+
+    async def command_matcher(
+        self, guild: Optional[discord.Guild], prefixes: List[str]
+    ) -> CommandMatcher:
+        """
+        Builds the matcher used to spot command messages in `safeclean bot`.
+
+        Prefixes go into a trie and the names of commands, aliases and
+        custom commands into a frozen set, once per cleanup.
+        """
+        names: Set[str] = set(self.bot.all_commands)
+        cc_cog = self.bot.get_cog("CustomCommands")
+        if cc_cog is not None and guild is not None:
+            names |= set(await cc_cog.get_command_names(guild))
+        alias_cog = self.bot.get_cog("Alias")
+        if alias_cog is not None:
+            names |= set(a.name for a in await alias_cog.unloaded_global_aliases())
+            if guild is not None:
+                names |= set(a.name for a in await alias_cog.unloaded_aliases(guild))
+
+        return CommandMatcher(prefixes, names)
+
+    async def build_check(
+        self, data: dict
+    ) -> Tuple[Callable[[discord.Message], bool], Callable[[discord.Message], bool]]:
+        """
+        Builds the check of a job from its saved filter.
+
+        Returns the check and a test telling whether its verdict on a
+        message whose content was truncated is final, whatever the end of
+        the content is (see `iter_messages_for_deletion`).
+
+        Filters are plain dicts so a job can be rebuilt after a restart:
+        - ``{"type": "all"}``
+        - ``{"type": "user", "user_id": int}``
+        - ``{"type": "text", "pattern": str}``
+        - ``{"type": "self", "pattern": str or None}``
+        - ``{"type": "bot", "prefixes": [str]}``
+        """
+        spec = data["filter"]
+        kind = spec["type"]
+        bot_id = self.bot.user.id
+
+        if kind == "user":
+            user_id = spec["user_id"]
+
+            def check(m):
+                return m.author.id == user_id
+
+            def settled(m):
+                return True
+
+        elif kind == "text":
+            content_match = ContentMatcher.from_argument(spec["pattern"], regexes=False)
+
+            def check(m):
+                return content_match(m.content)
+
+            def settled(m):
+                return content_match.settled(m.content)
+
+        elif kind == "self":
+            content_match = ContentMatcher.from_argument(spec["pattern"])
+
+            def check(m):
+                return m.author.id == bot_id and content_match(m.content)
+
+            def settled(m):
+                return m.author.id != bot_id or content_match.settled(m.content)
+
+        elif kind == "bot":
+            guild = self.bot.get_guild(data["guild"]) if data["guild"] else None
+            command_match = await self.command_matcher(guild, spec["prefixes"])
+
+            def check(m):
+                return m.author.id == bot_id or command_match(m.content)
+
+            def settled(m):
+                return m.author.id == bot_id or command_match.settled(m.content)
+
+        else:
+
+            def check(m):
+                return True
+
+            def settled(m):
+                return True
+
+        return check, settled
+
+    async def estimate_for_deletion(
+        self,
+        estimate: DeletionEstimate,
+        *,
+        include: Iterable[discord.abc.Snowflake] = (),
+        **kwargs
+    ):
+        """
+        Scans a channel like `delete_messages_for_deletion` would, without deleting anything.
+
+        The messages that would be deleted and the history pages read
+        are recorded in ``estimate``; messages served by the local index
+        cost no page.
+        """
+        fetched = 0
+        ids = []
+        async for batch in self.iter_messages_for_deletion(**kwargs):
+            fetched += batch.fetched
+            ids.extend(m.id for m in batch)
+        estimate.add_channel(fetched, ids)
+
+    async def process_job(
+        self,
+        job: PurgeJob,
+        check: Callable[[discord.Message], bool],
+        settled: Callable[[discord.Message], bool],
+        estimate: DeletionEstimate = None,
+    ) -> List[int]:
+        """
+        Cleans every unfinished channel of a job.
+
+        Channels are cleaned concurrently, up to the guild's configured
+        concurrency. Each channel has its own rate limit buckets for
+        message deletion, and only one pipeline ever runs per channel,
+        so channels never compete for a bucket.
+
+        The job is checkpointed to the config after every batch. With an
+        ``estimate``, the channels are only scanned.
+
+        A channel that fails doesn't stop the others. Returns the IDs of
+        the channels that could not be cleaned; `MessageNotFound` is
+        raised once every channel is done if a bound message is missing.
+        """
+        data = job.data
+        remaining = {
+            channel_id: state for channel_id, state in job.channels.items() if not state["done"]
+        }
+        guild = self.bot.get_guild(data["guild"]) if data["guild"] else None
+        concurrency = 1
+        if guild is not None and len(remaining) > 1:
+            concurrency = await self.config.guild(guild).channel_concurrency()
+        semaphore = asyncio.Semaphore(concurrency)
+        failed = []
+
+        async def clean(channel_id, state):
+            channel = self.bot.get_channel(int(channel_id))
+            if channel is None:
+                failed.append(int(channel_id))
+                return
+            number = None
+            if state["number"] is not None:
+                number = state["number"] - state["matched"]
+            if state["verify_before"]:
+                before = MessageBound(id=state["before"])
+            elif state["before"] is not None:
+                before = discord.Object(id=state["before"])
+            else:
+                before = None
+            after = discord.Object(id=state["after"]) if state["after"] is not None else None
+            kwargs = dict(
+                channel=channel,
+                number=number,
+                check=check,
+                before=before,
+                after=after,
+                delete_pinned=data["delete_pinned"],
+                settled=settled,
+            )
+            is_origin = channel.id == data["channel"]
+            include = [discord.Object(id=i) for i in data["include"]] if is_origin else []
+
+            async def checkpoint(cursor, matched, deleted):
+                state["before"] = cursor
+                state["verify_before"] = False
+                state["matched"] += matched
+                state["deleted"] += deleted
+                if is_origin:
+                    data["include"] = []
+                await self.config.jobs.set_raw(str(job.id), value=data)
+
+            async with semaphore:
+                if estimate is not None:
+                    return await self.estimate_for_deletion(estimate, **kwargs)
+                deleted_before = state["deleted"]
+                if number is not None and number <= 0:
+                    deleted = 0
+                else:
+                    try:
+                        deleted = await self.delete_messages_for_deletion(
+                            include=include, checkpoint=checkpoint, **kwargs
+                        )
+                    except discord.HTTPException as e:
+                        log.warning(
+                            "Could not clean channel %s (%s): %s", channel.name, channel.id, e
+                        )
+                        failed.append(channel.id)
+                        return
+            state["deleted"] = deleted_before + deleted
+            state["done"] = True
+            if is_origin:
+                data["include"] = []
+            await self.config.jobs.set_raw(str(job.id), value=data)
+
+        # Every channel runs to its end before the job is over, so none
+        # of them can checkpoint the job again after it has been cleared.
+        results = await asyncio.gather(
+            *(clean(*item) for item in remaining.items()), return_exceptions=True
+        )
+        not_found = None
+        for channel_id, result in zip(remaining, results):
+            if isinstance(result, asyncio.CancelledError):
+                # Before Python 3.8, a cancelled gather hands the children's
+                # cancellations back as results instead of raising.
+                raise result
+            if isinstance(result, MessageNotFound):
+                not_found = result
+            elif isinstance(result, BaseException):
+                log.error(
+                    "Could not clean channel %s.",
+                    channel_id,
+                    exc_info=(type(result), result, result.__traceback__),
+                )
+                failed.append(int(channel_id))
+        if not_found is not None:
+            raise not_found
+        if estimate is not None:
+            estimate.concurrency = concurrency
+        return failed
+
+    async def start_job(
+        self,
+        ctx: commands.Context,
+        *,
+        filter: dict,
+        channels: Dict[int, dict],
+        description: str,
+        delete_pinned: bool = False,
+        include: Iterable[discord.Message] = (),
+        report: bool = True,
+    ):
+        """
+        Starts a cleanup in the background.
+
+        When the command runs through `safeclean dryrun`, the cleanup is
+        only estimated and `DryRunFinished` stops the command.
+        """
+        estimate = getattr(ctx, "safeclean_estimate", None)
+        job_id = 0 if estimate is not None else await self.next_job_id()
+        job = PurgeJob.new(
+            job_id,
+            ctx,
+            filter=filter,
+            channels=channels,
+            description=description,
+            delete_pinned=delete_pinned,
+            include=include,
+            report=report,
+        )
+        # Built now so that invalid patterns are reported to the command.
+        check, settled = await self.build_check(job.data)
+        if estimate is not None:
+            await self.process_job(job, check, settled, estimate=estimate)
+            raise DryRunFinished()
+
+        if len(channels) > 1:
+            progress = await ctx.send(
+                _("Cleaning up the server (job #{id}), this may take a while...").format(id=job.id)
+            )
+            job.data["progress"] = progress.id
+        await self.config.jobs.set_raw(str(job.id), value=job.data)
+        finished = [old for old in self.jobs.values() if not old.active]
+        for old in finished[:-MAX_FINISHED_JOBS]:
+            del self.jobs[old.id]
+        self.jobs[job.id] = job
+        job.task = asyncio.ensure_future(self.run_job(job, check, settled))
+
+    async def next_job_id(self) -> int:
+        async with self._job_id_lock:
+            job_id = await self.config.next_job_id()
+            await self.config.next_job_id.set(job_id + 1)
+        return job_id
+
+    async def run_job(
+        self,
+        job: PurgeJob,
+        check: Callable[[discord.Message], bool],
+        settled: Callable[[discord.Message], bool],
+    ):
+        """Runs a job to completion, then reports and forgets its checkpoint."""
+        job.status = RUNNING
+        failed = []
+        try:
+            failed = await self.process_job(job, check, settled)
+        except asyncio.CancelledError:
+            if job.cancelled_by is None:
+                # The cog is unloading: keep the checkpoint to resume later.
+                job.status = PENDING
+                raise
+            job.status = CANCELLED
+        except MessageNotFound as e:
+            job.status = FAILED
+            job.error = _("Could not find a message with the ID of {id}.").format(id=e.message_id)
+        except Exception as e:
+            log.exception("Safeclean job %s failed.", job.id)
+            job.status = FAILED
+            job.error = _("Something went wrong while cleaning: {error}").format(error=e)
+        else:
+            job.status = FINISHED
+        job.ended = time.monotonic()
+        await self.config.jobs.clear_raw(str(job.id))
+        await self.report_job(job, failed)
+
+    async def report_job(self, job: PurgeJob, failed: List[int]):
+        """Logs the result of a job and tells the invoking channel about it."""
+        data = job.data
+        if len(job.channels) == 1:
+            channel = self.bot.get_channel(int(next(iter(job.channels))))
+            where = "channel {}".format(getattr(channel, "name", channel))
+        else:
+            where = "guild {} ({} channel(s) failed)".format(data["guild"], len(failed))
+        reason = "{}({}) deleted {} {} in {} (job {}, {}).".format(
+            data["author_name"],
+            data["author"],
+            job.deleted,
+            data["description"],
+            where,
+            job.id,
+            job.status,
+        )
+        log.info(reason)
+
+        if job.status == FINISHED:
+            if not data["report"]:
+                return
+            if len(job.channels) > 1:
+                content = _("Deleted {number} message(s) across the server.").format(
+                    number=job.deleted
+                )
+            else:
+                content = _("Deleted {number} message(s)").format(number=job.deleted)
+            if failed:
+                content += "\n" + _("Could not clean: {channels}").format(
+                    channels=", ".join("<#{}>".format(channel_id) for channel_id in failed)
+                )
+        elif job.status == CANCELLED:
+            content = _("Job #{id} was cancelled after deleting {number} message(s).").format(
+                id=job.id, number=job.deleted
+            )
+        else:
+            content = job.error
+
+        channel = self.bot.get_channel(data["channel"])
+        if channel is None:
+            return
+        try:
+            if data["progress"] is not None:
+                try:
+                    progress = await channel.fetch_message(data["progress"])
+                    return await progress.edit(content=content)
+                except discord.NotFound:
+                    pass
+            await channel.send(content)
+        except discord.HTTPException:
+            pass
+
+    async def resume_jobs(self):
+        """Restarts the jobs that were still running when the cog was unloaded."""
+        await self.bot.wait_until_ready()
+        for job_id, data in (await self.config.jobs()).items():
+            job = PurgeJob(int(job_id), data)
+            try:
+                check, settled = await self.build_check(data)
+            except Exception:
+                log.exception("Could not resume safeclean job %s.", job_id)
+                await self.config.jobs.clear_raw(job_id)
+                continue
+            log.info("Resuming safeclean job %s.", job_id)
+            self.jobs[job.id] = job
+            job.task = asyncio.ensure_future(self.run_job(job, check, settled))
+
+    def cog_unload(self):
+        self._resume_task.cancel()
+        for job in self.jobs.values():
+            if job.task is not None and not job.task.done():
+                job.task.cancel()
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        """Keeps the recent message index of guild channels."""
+        if message.guild is not None:
+            self.index.add(message)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        self.index.remove(payload.channel_id, [payload.message_id])
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        self.index.remove(payload.channel_id, payload.message_ids)
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        self.index.edit(int(payload.data["channel_id"]), payload.message_id, payload.data)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        self.index.forget(channel.id)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # After a new session, messages sent while disconnected are unknown.
+        self.index.forget()
+
     @commands.group()
     @checks.admin_or_permissions(manage_messages=True)
     async def safeclean(self, ctx: commands.Context):
-        """Delete messages."""
+        """Delete messages.
+
+        Cleanups run in the background: see `[p]safeclean jobs`.
+        """
         pass
 
     @safeclean.command()
@@ -117,43 +735,29 @@ class SafeClean(commands.Cog):
     ):
         """Delete the last X messages matching the specified text.
 
+        Several keywords can be separated with |; write \\| for
+        a | that is part of a keyword.
+
         Example:
             `[p]safeclean text "test" 5`
+            `[p]safeclean text "spam|free nitro|a \\| b" 50`
 
         Remember to use double quotes.
         """
 
-        channel = ctx.channel
-
-        author = ctx.author
-
         if number > 100:
             cont = await self.check_100_plus(ctx, number)
             if not cont:
                 return
 
-        def check(m):
-            if text in m.content:
-                return True
-            else:
-                return False
-
-        to_delete = await self.get_messages_for_deletion(
-            channel=channel,
-            number=number,
-            check=check,
-            before=ctx.message,
+        await self.start_job(
+            ctx,
+            filter={"type": "text", "pattern": text},
+            channels={ctx.channel.id: channel_state(number=number, before=ctx.message)},
+            description="messages containing '{}'".format(text),
             delete_pinned=delete_pinned,
+            include=[ctx.message],
         )
-        to_delete.append(ctx.message)
-
-        reason = "{}({}) deleted {} messages containing '{}' in channel {}.".format(
-            author.name, author.id, len(to_delete), text, channel.id
-        )
-        log.info(reason)
-        
-        deleted = await channel.purge(check=check)
-        await channel.send('Deleted {} message(s)'.format(len(deleted)))
 
     @safeclean.command()
     @commands.guild_only()
@@ -167,50 +771,21 @@ class SafeClean(commands.Cog):
             `[p]safeclean user @\u200bTwentysix 2`
             `[p]safeclean user Red 6`
         """
-        channel = ctx.channel
-
-        member = None
-        try:
-            member = await commands.MemberConverter().convert(ctx, user)
-        except commands.BadArgument:
-            try:
-                _id = int(user)
-            except ValueError:
-                raise commands.BadArgument()
-        else:
-            _id = member.id
-
-        author = ctx.author
+        member, _id = await self.resolve_user(ctx, user)
 
         if number > 100:
             cont = await self.check_100_plus(ctx, number)
             if not cont:
                 return
 
-        def check(m):
-            if m.author.id == _id:
-                return True
-            else:
-                return False
-
-        to_delete = await self.get_messages_for_deletion(
-            channel=channel,
-            number=number,
-            check=check,
-            before=ctx.message,
+        await self.start_job(
+            ctx,
+            filter={"type": "user", "user_id": _id},
+            channels={ctx.channel.id: channel_state(number=number, before=ctx.message)},
+            description="messages made by {}({})".format(member or "???", _id),
             delete_pinned=delete_pinned,
+            include=[ctx.message],
         )
-        to_delete.append(ctx.message)
-
-        reason = (
-            "{}({}) deleted {} messages "
-            " made by {}({}) in channel {}."
-            "".format(author.name, author.id, len(to_delete), member or "???", _id, channel.name)
-        )
-        log.info(reason)
-
-        deleted = await channel.purge(check=check)
-        await channel.send('Deleted {} message(s)'.format(len(deleted)))
 
     @safeclean.command()
     @commands.guild_only()
@@ -224,30 +799,19 @@ class SafeClean(commands.Cog):
         settings, 'appearance' tab. Then right click a message
         and copy its id.
         """
+        if not await self.message_exists(ctx.channel, message_id.id):
+            return await ctx.send(
+                _("Could not find a message with the ID of {id}.").format(id=message_id.id)
+            )
 
-        channel = ctx.channel
-        author = ctx.author
-        
-        try:
-            after = await channel.fetch_message(message_id)
-        except discord.NotFound:
-            return await ctx.send(_("Message not found."))
-
-        to_delete = await self.get_messages_for_deletion(
-            channel=channel, number=None, after=after, delete_pinned=delete_pinned
-        )
-        
-        def check(m):
-            for message in to_delete:
-                if m.id == message.id:
-                    return True
-            return False
-
-        deleted = await channel.purge(check=check)
-        reason = "{}({}) deleted {} messages in channel {}.".format(
-            author.name, author.id, len(deleted), channel.name
+        await self.start_job(
+            ctx,
+            filter={"type": "all"},
+            channels={ctx.channel.id: channel_state(after=message_id)},
+            description="messages",
+            delete_pinned=delete_pinned,
+            report=False,
         )
-        log.info(reason)
 
     @safeclean.command()
     @commands.guild_only()
@@ -266,30 +830,17 @@ class SafeClean(commands.Cog):
         and copy its id.
         """
 
-        channel = ctx.channel
-        author = ctx.author
-            
-        try:
-            before = await channel.fetch_message(message_id)
-        except discord.NotFound:
-            return await ctx.send(_("Message not found."))
-
-        to_delete = await self.get_messages_for_deletion(
-            channel=channel, number=number, before=before, delete_pinned=delete_pinned
-        )
-        to_delete.append(ctx.message)
-
-        def check(m):
-            for message in to_delete:
-                if m.id == message.id:
-                    return True
-            return False
-
-        deleted = await channel.purge(check=check)
-        reason = "{}({}) deleted {} messages in channel {}.".format(
-            author.name, author.id, len(deleted), channel.name
+        await self.start_job(
+            ctx,
+            filter={"type": "all"},
+            channels={
+                ctx.channel.id: channel_state(number=number, before=message_id, verify_before=True)
+            },
+            description="messages",
+            delete_pinned=delete_pinned,
+            include=[ctx.message],
+            report=False,
         )
-        log.info(reason)
 
     @safeclean.command()
     @commands.guild_only()
@@ -308,37 +859,24 @@ class SafeClean(commands.Cog):
         Example:
             `[p]safeclean between 123456789123456789 987654321987654321`
         """
-        channel = ctx.channel
-        author = ctx.author
-
-        try:
-            mone = await channel.fetch_message(one)
-        except discord.errors.NotFound:
+        if one.id >= two.id:
+            return await ctx.send(_("The first message should be older than the second one."))
+        if not await self.message_exists(ctx.channel, one.id):
             return await ctx.send(
-                _("Could not find a message with the ID of {id}.".format(id=one))
+                _("Could not find a message with the ID of {id}.").format(id=one.id)
             )
-        try:
-            mtwo = await channel.fetch_message(two)
-        except discord.errors.NotFound:
-            return await ctx.send(
-                _("Could not find a message with the ID of {id}.".format(id=two))
-            )
-        to_delete = await self.get_messages_for_deletion(
-            channel=channel, before=mtwo, after=mone, delete_pinned=delete_pinned
-        )
-        to_delete.append(ctx.message)
 
-        def check(m):
-            for message in to_delete:
-                if m.id == message.id:
-                    return True
-            return False
-
-        deleted = await channel.purge(check=check)
-        reason = "{}({}) deleted {} messages in channel {}.".format(
-            author.name, author.id, len(deleted), channel.name
+        await self.start_job(
+            ctx,
+            filter={"type": "all"},
+            channels={
+                ctx.channel.id: channel_state(before=two, after=one, verify_before=True)
+            },
+            description="messages",
+            delete_pinned=delete_pinned,
+            include=[ctx.message],
+            report=False,
         )
-        log.info(reason)
 
     @safeclean.command()
     @commands.guild_only()
@@ -350,25 +888,15 @@ class SafeClean(commands.Cog):
             `[p]safeclean messages 26`
         """
 
-        channel = ctx.channel
-        author = ctx.author
-
-        to_delete = await self.get_messages_for_deletion(
-            channel=channel, number=number, before=ctx.message, delete_pinned=delete_pinned
-        )
-        to_delete.append(ctx.message)
-
-        def check(m):
-            for message in to_delete:
-                if m.id == message.id:
-                    return True
-            return False
-
-        deleted = await channel.purge(check=check)
-        reason = "{}({}) deleted {} messages in channel {}.".format(
-            author.name, author.id, len(deleted), channel.name
+        await self.start_job(
+            ctx,
+            filter={"type": "all"},
+            channels={ctx.channel.id: channel_state(number=number, before=ctx.message)},
+            description="messages",
+            delete_pinned=delete_pinned,
+            include=[ctx.message],
+            report=False,
         )
-        log.info(reason)
 
     @safeclean.command(name="bot")
     @commands.guild_only()
@@ -376,9 +904,6 @@ class SafeClean(commands.Cog):
     async def safeclean_bot(self, ctx: commands.Context, number: int, delete_pinned: bool = False):
         """Clean up command messages and messages from the bot."""
 
-        channel = ctx.channel
-        author = ctx.message.author
-
         if number > 100:
             cont = await self.check_100_plus(ctx, number)
             if not cont:
@@ -388,59 +913,14 @@ class SafeClean(commands.Cog):
         if isinstance(prefixes, str):
             prefixes = [prefixes]
 
-        # In case some idiot sets a null prefix
-        if "" in prefixes:
-            prefixes.remove("")
-
-        cc_cog = self.bot.get_cog("CustomCommands")
-        if cc_cog is not None:
-            command_names: Set[str] = await cc_cog.get_command_names(ctx.guild)
-            is_cc = lambda name: name in command_names
-        else:
-            is_cc = lambda name: False
-        alias_cog = self.bot.get_cog("Alias")
-        if alias_cog is not None:
-            alias_names: Set[str] = (
-                set((a.name for a in await alias_cog.unloaded_global_aliases()))
-                | set(a.name for a in await alias_cog.unloaded_aliases(ctx.guild))
-            )
-            is_alias = lambda name: name in alias_names
-        else:
-            is_alias = lambda name: False
-
-        bot_id = self.bot.user.id
-
-        def check(m):
-            if m.author.id == bot_id:
-                return True
-            elif m == ctx.message:
-                return True
-            p = discord.utils.find(m.content.startswith, prefixes)
-            if p and len(p) > 0:
-                cmd_name = m.content[len(p) :].split(" ")[0]
-                return (
-                    bool(self.bot.get_command(cmd_name)) or is_alias(cmd_name) or is_cc(cmd_name)
-                )
-            return False
-
-        to_delete = await self.get_messages_for_deletion(
-            channel=channel,
-            number=number,
-            check=check,
-            before=ctx.message,
+        await self.start_job(
+            ctx,
+            filter={"type": "bot", "prefixes": list(prefixes)},
+            channels={ctx.channel.id: channel_state(number=number, before=ctx.message)},
+            description="command messages",
             delete_pinned=delete_pinned,
+            include=[ctx.message],
         )
-        to_delete.append(ctx.message)
-
-        reason = (
-            "{}({}) deleted {} "
-            " command messages in channel {}."
-            "".format(author.name, author.id, len(to_delete), channel.name)
-        )
-        log.info(reason)
-
-        deleted = await channel.purge(check=check)
-        await channel.send('Deleted {} message(s)'.format(len(deleted)))
 
     @safeclean.command(name="self")
     async def safeclean_self(
@@ -456,63 +936,258 @@ class SafeClean(commands.Cog):
         it is used for pattern matching: If it begins with r( and ends with ),
         then it is interpreted as a regex, and messages that match it are
         deleted. Otherwise, it is used in a simple substring test.
+        Several patterns can be separated with |; outside of a regex,
+        write \\| for a | that is part of a pattern.
 
         Some helpful regex flags to include in your pattern:
         Dots match newlines: (?s); Ignore case: (?i); Both: (?si)
         """
-        channel = ctx.channel
-        author = ctx.message.author
 
         if number > 100:
             cont = await self.check_100_plus(ctx, number)
             if not cont:
                 return
 
-        use_re = match_pattern and match_pattern.startswith("r(") and match_pattern.endswith(")")
+        await self.start_job(
+            ctx,
+            filter={"type": "self", "pattern": match_pattern},
+            channels={ctx.channel.id: channel_state(number=number, before=ctx.message)},
+            description="messages sent by the bot",
+            delete_pinned=delete_pinned,
+        )
+
+    @safeclean.command(name="jobs")
+    async def safeclean_jobs(self, ctx: commands.Context):
+        """Show the progress of the cleanups started in this server."""
+        jobs = [
+            job
+            for job in self.jobs.values()
+            if job.data["guild"] == (ctx.guild.id if ctx.guild else None)
+            and (ctx.guild or job.data["channel"] == ctx.channel.id)
+        ]
+        if not jobs:
+            return await ctx.send(_("No cleanup has been started since the cog was loaded."))
+        lines = [
+            _(
+                "#{id} {status}: {deleted} message(s) deleted, {done}/{total} channel(s) done,"
+                " {elapsed} elapsed ({description})"
+            ).format(
+                id=job.id,
+                status=job.status,
+                deleted=job.deleted,
+                done=job.channels_done,
+                total=len(job.channels),
+                elapsed=job.elapsed,
+                description=job.data["description"],
+            )
+            for job in sorted(jobs, key=lambda job: job.id)
+        ]
+        for page in pagify("\n".join(lines)):
+            await ctx.send(box(page))
+
+    @safeclean.command(name="cancel")
+    async def safeclean_cancel(self, ctx: commands.Context, job_id: int):
+        """Cancel a running cleanup.
+
+        Messages deleted so far stay deleted.
+        """
+        job = self.jobs.get(job_id)
+        if job is None or job.data["guild"] != (ctx.guild.id if ctx.guild else None):
+            return await ctx.send(_("There is no job with the ID {id}.").format(id=job_id))
+        if not job.active:
+            return await ctx.send(
+                _("Job #{id} is already {status}.").format(id=job_id, status=job.status)
+            )
+        job.cancelled_by = ctx.author.id
+        job.task.cancel()
+        await ctx.tick()
+
+    @safeclean.command(name="concurrency")
+    @commands.guild_only()
+    @checks.admin_or_permissions(manage_guild=True)
+    async def safeclean_concurrency(self, ctx: commands.Context, limit: int = None):
+        """Set how many channels guild-wide cleanups work on at once.
 
-        if use_re:
-            match_pattern = match_pattern[1:]  # strip 'r'
-            match_re = re.compile(match_pattern)
+        Without a number, shows the current setting.
+        """
+        if limit is None:
+            limit = await self.config.guild(ctx.guild).channel_concurrency()
+            return await ctx.send(
+                _("Guild-wide cleanups work on {limit} channel(s) at once.").format(limit=limit)
+            )
+        if not 1 <= limit <= 20:
+            return await ctx.send(_("The limit should be between 1 and 20."))
+        await self.config.guild(ctx.guild).channel_concurrency.set(limit)
+        await ctx.send(
+            _("Guild-wide cleanups will now work on {limit} channel(s) at once.").format(
+                limit=limit
+            )
+        )
 
-            def content_match(c):
-                return bool(match_re.match(c))
+    @safeclean.command(name="dryrun")
+    async def safeclean_dryrun(self, ctx: commands.Context, *, command: str):
+        """Estimate a cleanup without deleting anything.
 
-        elif match_pattern:
+        Runs another safeclean subcommand with the same arguments and
+        reports how many messages it would delete, the API calls it
+        would make and roughly how long it would take.
 
-            def content_match(c):
-                return match_pattern in c
+        Example:
+            `[p]safeclean dryrun user @\u200bTwentysix 500`
+            `[p]safeclean dryrun guild text "spam" 50`
+        """
+        words = command.split()
+        subcommand = self.safeclean.get_command(" ".join(words[:2])) or self.safeclean.get_command(
+            words[0]
+        )
+        if (
+            subcommand is None
+            or isinstance(subcommand, commands.Group)
+            or subcommand.name in ("dryrun", "jobs", "cancel", "concurrency")
+        ):
+            return await ctx.send_help()
 
+        message = copy(ctx.message)
+        message.content = "{}{} {}".format(ctx.prefix, self.safeclean.qualified_name, command)
+        new_ctx = await self.bot.get_context(message, cls=type(ctx))
+        new_ctx.assume_yes = True
+        new_ctx.safeclean_estimate = estimate = DeletionEstimate()
+        try:
+            await new_ctx.command.invoke(new_ctx)
+        except commands.CommandInvokeError as e:
+            if isinstance(e.original, MessageNotFound):
+                return await ctx.send(
+                    _("Could not find a message with the ID of {id}.").format(
+                        id=e.original.message_id
+                    )
+                )
+            if not isinstance(e.original, DryRunFinished):
+                raise
         else:
+            # The command stopped before scanning anything and said why.
+            return
+
+        await ctx.send(
+            _(
+                "Dry run, nothing was deleted.\n"
+                "Matching messages: {matched} ({bulk} bulk deletable, {single} too old for bulk)\n"
+                "History pages read: {pages} in {channels} channel(s)\n"
+                "Projected API calls: {bulk_calls} bulk delete(s), {single} single delete(s)\n"
+                "Estimated time: {duration}"
+            ).format(
+                matched=estimate.matched,
+                bulk=estimate.bulk,
+                single=estimate.single,
+                pages=estimate.pages,
+                channels=estimate.channels,
+                bulk_calls=estimate.bulk_calls,
+                duration=estimate.duration,
+            )
+        )
 
-            def content_match(_):
-                return True
+    @safeclean.group(name="guild")
+    @commands.guild_only()
+    @commands.bot_has_permissions(manage_messages=True)
+    async def safeclean_guild(self, ctx: commands.Context):
+        """Delete messages in every text channel of the server.
 
-        def check(m):
-            if m.author.id != self.bot.user.id:
-                return False
-            elif content_match(m.content):
-                return True
-            return False
+        The number of messages applies to each channel.
+        """
+        pass
+
+    @staticmethod
+    def guild_channels(ctx: commands.Context, number: int) -> Dict[int, dict]:
+        """
+        Builds the channel states of a guild-wide job.
+
+        Only the channels where both the bot and the author can read the
+        history and manage messages are cleaned: the command's own check
+        is only evaluated in the invoking channel.
+        """
+        guild = ctx.guild
+
+        def can_clean(channel, member):
+            permissions = channel.permissions_for(member)
+            return permissions.read_message_history and permissions.manage_messages
+
+        return {
+            channel.id: channel_state(number=number, before=ctx.message)
+            for channel in guild.text_channels
+            if can_clean(channel, guild.me) and can_clean(channel, ctx.author)
+        }
+
+    @safeclean_guild.command(name="text")
+    async def guild_text(
+        self, ctx: commands.Context, text: str, number: int, delete_pinned: bool = False
+    ):
+        """Delete the last X messages matching the specified text in every channel.
+
+        Example:
+            `[p]safeclean guild text "test" 5`
 
-        to_delete = await self.get_messages_for_deletion(
-            channel=channel,
-            number=number,
-            check=check,
-            before=ctx.message,
+        Remember to use double quotes.
+        """
+        if number > 100:
+            cont = await self.check_100_plus(ctx, number)
+            if not cont:
+                return
+
+        await self.start_job(
+            ctx,
+            filter={"type": "text", "pattern": text},
+            channels=self.guild_channels(ctx, number),
+            description="messages containing '{}'".format(text),
             delete_pinned=delete_pinned,
+            include=[ctx.message],
         )
 
-        if ctx.guild:
-            channel_name = "channel " + channel.name
-        else:
-            channel_name = str(channel)
+    @safeclean_guild.command(name="user")
+    async def guild_user(
+        self, ctx: commands.Context, user: str, number: int, delete_pinned: bool = False
+    ):
+        """Delete the last X messages from a specified user in every channel.
+
+        Examples:
+            `[p]safeclean guild user @\u200bTwentysix 2`
+            `[p]safeclean guild user Red 6`
+        """
+        member, _id = await self.resolve_user(ctx, user)
+
+        if number > 100:
+            cont = await self.check_100_plus(ctx, number)
+            if not cont:
+                return
 
-        reason = (
-            "{}({}) deleted {} messages "
-            "sent by the bot in {}."
-            "".format(author.name, author.id, len(to_delete), channel_name)
+        await self.start_job(
+            ctx,
+            filter={"type": "user", "user_id": _id},
+            channels=self.guild_channels(ctx, number),
+            description="messages made by {}({})".format(member or "???", _id),
+            delete_pinned=delete_pinned,
+            include=[ctx.message],
         )
-        log.info(reason)
 
-        deleted = await channel.purge(check=check)
-        await channel.send('Deleted {} message(s)'.format(len(deleted)))
+    @safeclean_guild.command(name="self")
+    async def guild_self(
+        self,
+        ctx: commands.Context,
+        number: int,
+        match_pattern: str = None,
+        delete_pinned: bool = False,
+    ):
+        """Clean up messages owned by the bot in every channel.
+
+        The pattern works like in `[p]safeclean self`.
+        """
+        if number > 100:
+            cont = await self.check_100_plus(ctx, number)
+            if not cont:
+                return
+
+        await self.start_job(
+            ctx,
+            filter={"type": "self", "pattern": match_pattern},
+            channels=self.guild_channels(ctx, number),
+            description="messages sent by the bot",
+            delete_pinned=delete_pinned,
+        )
@@ -1,40 +1,47 @@
+from datetime import date, datetime, timedelta
+import asyncio
 import concurrent.futures
 import functools
-from datetime import datetime, timedelta
-import asyncio
 import locale
-from dateutil.relativedelta import relativedelta
+import logging
+import os
+import tempfile
 from redbot.core import checks, Config, commands
 from redbot.core.data_manager import cog_data_path
+from redbot.core.utils.menus import DEFAULT_CONTROLS, menu
 import discord
-import apsw
+
+from .store import FLUSH_INTERVAL, PRUNE_INTERVAL, WINDOWS, StatsStore
+
+log = logging.getLogger('red.stats')
 
 locale.setlocale(locale.LC_ALL, 'fr_FR.utf8')
 
+TOP_SIZE = 10
+
+
 class Stats(commands.Cog):
     """Stats"""
 
     def __init__(self, bot):
         self.bot = bot
         self.config = Config.get_conf(self, 15646546161512)
-        self._connection = apsw.Connection(str(cog_data_path(self) / 'stats.db'))
-        self.cursor = self._connection.cursor()
-        self.cursor.execute('PRAGMA journal_mode = wal;')
-        self.cursor.execute('PRAGMA read_uncommitted = 1;')
-        self.cursor.execute(
-            'CREATE TABLE IF NOT EXISTS member_stats ('
-            'user_id INTEGER NOT NULL,'
-            'message_quantity INTEGER DEFAULT 1,'
-            'voice_time INTEGER DEFAULT 1,'
-            'joined_voice_time INTEGER DEFAULT 1,'
-            'PRIMARY KEY (user_id)'
-            ');'
-        )
-        self._executor = concurrent.futures.ThreadPoolExecutor(1)
-        self.time = int(((datetime.now().replace(day=1, hour=0, minute=0, second=0) + relativedelta(months=1))-datetime.now()).total_seconds())
+        self.config.register_global(legacy_checked=False)
+        # One database per guild, in guilds/<guild_id>.db. The stats.db of
+        # older versions mixed every guild together and is left untouched;
+        # its message counts are imported when the bot is in a single guild.
+        self._legacy_path = cog_data_path(self) / 'stats.db'
+        # The ID of the guild stats.db is imported into, or None, once the
+        # bot is ready. New databases wait for it before their first write.
+        self._legacy_owner = concurrent.futures.Future()
+        self._path = cog_data_path(self) / 'guilds'
+        self._path.mkdir(parents=True, exist_ok=True)
+        self.stores = {}
+        self.flush_task = self.bot.loop.create_task(self.flush_loop())
         self.task = self.bot.loop.create_task(self.cleanup_db())
+        self.bot.loop.create_task(self.initialize())
 
-    @commands.command(pass_context=True)
+    @commands.group(pass_context=True, invoke_without_command=True)
     async def stats(self, ctx):
         """Affiche les statistiques d'un utilisateur"""
         users = ctx.message.mentions
@@ -47,96 +54,238 @@ class Stats(commands.Cog):
             em.add_field(name="Date d'arrivée sur le serveur", value=k.joined_at.__format__('%A %d %B %Y à %H:%M:%S'))
             await ctx.send(embed=em)
 
+    @stats.command(name='top')
+    @commands.guild_only()
+    async def stats_top(self, ctx, kind: str = 'messages', window: str = 'all'):
+        """Affiche le classement des membres
+
+        kind: messages ou voice
+        window: today, 7d, 30d ou all"""
+        if kind not in ('messages', 'voice'):
+            return await ctx.send_help()
+        windows = {name: days for name, label, days in WINDOWS}
+        if window != 'all' and window not in windows:
+            return await ctx.send_help()
+        store = self.store(ctx.guild)
+        await store.flush()
+        await store.write(store.roll_windows)
+        rows, rank = await store.read(
+            store.top_members, kind, windows.get(window), ctx.author.id, TOP_SIZE
+        )
+        if not rows:
+            return await ctx.send('No stats yet')
+        await ctx.send(embed=self.ranking('Classement {} ({})'.format(kind, window), kind, rows, rank))
+
+    @stats.command(name='month')
+    @commands.guild_only()
+    @checks.admin()
+    async def stats_month(self, ctx, month: str, kind: str = 'messages'):
+        """Affiche le classement d'un mois passé
+
+        month: AAAA-MM
+        kind: messages ou voice"""
+        try:
+            parsed = datetime.strptime(month, '%Y-%m')
+        except ValueError:
+            return await ctx.send_help()
+        if kind not in ('messages', 'voice'):
+            return await ctx.send_help()
+        store = self.store(ctx.guild)
+        rows = await store.read(store.month_top, parsed.year * 100 + parsed.month, kind, TOP_SIZE)
+        if not rows:
+            return await ctx.send('No stats for this month')
+        await ctx.send(embed=self.ranking('Classement {} ({})'.format(kind, month), kind, rows))
+
+    @stats.command(name='export')
+    @commands.guild_only()
+    @checks.admin()
+    async def stats_export(self, ctx):
+        """Envoie l'activité de tous les membres en CSV compressé"""
+        store = self.store(ctx.guild)
+        # A file of its own, so concurrent exports don't overwrite each other.
+        fd, path = tempfile.mkstemp(suffix='.csv.gz')
+        os.close(fd)
+
+        def get_name(user_id):
+            member = ctx.guild.get_member(user_id)
+            return str(member) if member is not None else ''
+
+        async with ctx.typing():
+            await store.flush()
+            await store.write(store.roll_windows)
+            try:
+                rows = await store.read(store.export_members, path, get_name)
+                if not rows:
+                    return await ctx.send('No stats yet')
+                filename = 'stats-{}-{}.csv.gz'.format(ctx.guild.id, date.today().isoformat())
+                await ctx.send(
+                    '{} membres'.format(rows), file=discord.File(path, filename=filename)
+                )
+            finally:
+                os.remove(path)
+
+    @staticmethod
+    def ranking(title, kind, rows, rank=None):
+        """Builds the embed of a [(user_id, value)] ranking."""
+        def show(value):
+            return value if kind == 'messages' else timedelta(seconds=value)
+
+        lines = [
+            '**{}.** <@{}> : {}'.format(position, user_id, show(value))
+            for position, (user_id, value) in enumerate(rows, 1)
+        ]
+        if rank is not None:
+            lines.append('\nVotre rang : **{}** ({})'.format(rank[0], show(rank[1])))
+        return discord.Embed(title=title, description='\n'.join(lines), colour=0x00ff40)
+
     @commands.command(pass_context=True)
+    @commands.guild_only()
     @checks.admin()
     async def stats_admin(self, ctx):
-        """Affiche les statistiques d'un utilisateur"""
-        users = ctx.message.mentions
+        """Affiche les statistiques d'un ou plusieurs utilisateurs"""
+        users = list(dict.fromkeys(ctx.message.mentions))
+        if not users:
+            return await ctx.send_help()
+        store = self.store(ctx.guild)
+        await store.flush()
+        await store.write(store.roll_windows)
+        results = await store.read(store.members_activity, [k.id for k in users])
+        missing = [k for k in users if k.id not in results]
+        if not results:
+            return await ctx.send('No stats yet for ' + ', '.join(k.mention for k in missing))
+        pages = []
         for k in users:
-            result = self.cursor.execute(
-                'SELECT message_quantity, voice_time FROM member_stats '
-                'WHERE user_id = ?',
-                [k.id]
-            ).fetchall()
-            if not result:
-                return await ctx.send('This user have no stats yet')
+            if k.id not in results:
+                continue
+            messages, voice = results[k.id]
             em = discord.Embed(description='Stats of <@' + str(k.id) +'>', colour=0x00ff40)
             em.set_thumbnail(url=k.avatar_url)
             em.add_field(name='Nom', value=k.nick, inline=True)
             em.add_field(name='Status', value=k.status, inline=True)
             em.add_field(name="Date de création du compte", value=k.created_at.__format__('%A %d %B %Y à %H:%M:%S'))
             em.add_field(name="Date d'arrivée sur le serveur", value=k.joined_at.__format__('%A %d %B %Y à %H:%M:%S'), inline=False)
-            em.add_field(name="Messages envoyés", value=result[0][0], inline=True)
-            em.add_field(name="Temps passé en vocal", value=timedelta(seconds=result[0][1]), inline=True)
-            
-            await ctx.send(embed=em)
+            em.add_field(
+                name="Messages envoyés",
+                value='\n'.join('{} : {}'.format(name, value) for name, value in messages),
+                inline=True
+            )
+            em.add_field(
+                name="Temps passé en vocal",
+                value='\n'.join(
+                    '{} : {}'.format(name, timedelta(seconds=value)) for name, value in voice
+                ),
+                inline=True
+            )
+            pages.append(em)
+        for page, em in enumerate(pages, 1):
+            footer = '{}/{}'.format(page, len(pages))
+            if missing:
+                footer += ' · Sans stats : ' + ', '.join(k.display_name for k in missing)
+            em.set_footer(text=footer[:2048])
+        if len(pages) == 1:
+            return await ctx.send(embed=pages[0])
+        await menu(ctx, pages, DEFAULT_CONTROLS)
 
     def cog_unload(self):
-        self._executor.shutdown()
+        if self.flush_task:
+            self.flush_task.cancel()
+        if not self._legacy_owner.done():
+            self._legacy_owner.set_result(None)
+        for store in self.stores.values():
+            store.close()
         if self.task:
             self.task.cancel()
 
+    def store(self, guild):
+        """Returns the stats database of a guild, opening it on first use."""
+        store = self.stores.get(guild.id)
+        if store is None:
+            store = self.stores[guild.id] = StatsStore(
+                self._path / '{}.db'.format(guild.id),
+                self.bot.loop,
+                functools.partial(self.legacy_path, guild.id)
+            )
+        return store
+
+    def legacy_path(self, guild_id):
+        """Waits for the owner of stats.db and returns its path if it is guild_id, in a store's thread."""
+        if self._legacy_owner.result() == guild_id:
+            return str(self._legacy_path)
+        return None
+
+    async def initialize(self):
+        await self.bot.wait_until_ready()
+        owner = None
+        try:
+            owner = await self.legacy_owner()
+        finally:
+            # The stores must never be left waiting, even if the config fails.
+            if not self._legacy_owner.done():
+                self._legacy_owner.set_result(owner)
+        self.reconcile_voice()
+
+    async def legacy_owner(self):
+        """
+        Returns the ID of the guild the stats.db of older versions belongs to, the first time.
+
+        Its counts can only be attributed when the bot is in a single
+        guild; otherwise the file is left as is.
+        """
+        if await self.config.legacy_checked() or not self._legacy_path.exists():
+            return None
+        await self.config.legacy_checked.set(True)
+        guilds = self.bot.guilds
+        if len(guilds) != 1:
+            log.warning('The stats of %s were not migrated: they mix every guild together.', self._legacy_path)
+            return None
+        return guilds[0].id
+
+    def reconcile_voice(self):
+        """Seeds the voice sessions from the members of every guild's voice channels."""
+        now = datetime.timestamp(datetime.now())
+        for guild in self.bot.guilds:
+            user_ids = {
+                member.id
+                for channel in guild.voice_channels
+                for member in channel.members
+                if not member.bot
+            }
+            if user_ids or guild.id in self.stores:
+                self.store(guild).reconcile_voice(user_ids, now)
+
+    async def flush_loop(self):
+        """Loop task that writes the buffered counters of every guild."""
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            for store in self.stores.values():
+                store.flush_soon()
+
     async def cleanup_db(self):
-        """Loop task that sends reminders."""
+        """Loop task that archives the finished months and prunes the old buckets."""
         await self.bot.wait_until_ready()
         while self.bot.get_cog("Stats") == self:
-            await asyncio.sleep(self.time)
-            self.time = int(((datetime.now().replace(day=1, hour=0, minute=0, second=0) + relativedelta(months=1))-datetime.now()).total_seconds())
-            query = (
-                'DELETE FROM member_stats'
-            )
-            data = []
-            task = functools.partial(self.safe_write, query, data)
-            await self.bot.loop.run_in_executor(self._executor, task)
+            for store in list(self.stores.values()):
+                await store.prune()
+            await asyncio.sleep(PRUNE_INTERVAL)
 
-    def safe_write(self, query, data):
-        """Func for safely writing in another thread."""
-        cursor = self._connection.cursor()
-        cursor.execute(query, data)
+    @commands.Cog.listener()
+    async def on_ready(self):
+        """Catches up with the voice changes missed while disconnected."""
+        self.reconcile_voice()
 
     @commands.Cog.listener()
     async def on_message_without_command(self, msg):
         """Passively records all message contents."""
         if not msg.author.bot and isinstance(msg.channel, discord.TextChannel):
-            query = (
-                'INSERT INTO member_stats (user_id, voice_time, joined_voice_time)'
-                'VALUES (?, 0, 0)'
-                'ON CONFLICT(user_id) DO UPDATE SET message_quantity = message_quantity + 1;'
-            )
-            data = [msg.author.id]
-            task = functools.partial(self.safe_write, query, data)
-            await self.bot.loop.run_in_executor(self._executor, task)
+            self.store(msg.guild).add_message(msg.author.id)
 
     @commands.Cog.listener()
     async def on_voice_state_update(self, member, before, after):
         """Passively records all voice activity."""
         if not member.bot:
+            store = self.store(member.guild)
+            now = datetime.timestamp(datetime.now())
             if (before.channel is None) and not (after.channel is None):
-                query = (
-                    'INSERT INTO member_stats (user_id, message_quantity, joined_voice_time)'
-                    'VALUES (?, 0, ?)'
-                    'ON CONFLICT(user_id) DO UPDATE SET joined_voice_time = ?;'
-                )
-                now = datetime.now()
-                data = [member.id, datetime.timestamp(now), datetime.timestamp(now)]
-                task = functools.partial(self.safe_write, query, data)
-                await self.bot.loop.run_in_executor(self._executor, task)
+                store.join_voice(member.id, now)
             elif not (before.channel is None) and (after.channel is None):
-                result = self.cursor.execute(
-                    'SELECT joined_voice_time FROM member_stats '
-                    'WHERE user_id = ?',
-                    [member.id]
-                ).fetchall()
-                if not result or result[0][0] == 0:
-                    return
-                joined_voice_time = datetime.fromtimestamp(result[0][0])
-                query = (
-                    'INSERT INTO member_stats (user_id, message_quantity, voice_time, joined_voice_time)'
-                    'VALUES (?, 0, ?, 0)'
-                    'ON CONFLICT(user_id) DO UPDATE SET voice_time = message_quantity + ?;'
-                )
-                now = datetime.now()
-                time = round((now-joined_voice_time).total_seconds())
-                data = [member.id, time, time]
-                task = functools.partial(self.safe_write, query, data)
-                await self.bot.loop.run_in_executor(self._executor, task)
\ No newline at end of file
+                store.leave_voice(member.id, now)
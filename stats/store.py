@@ -0,0 +1,560 @@
+import asyncio
+import concurrent.futures
+import csv
+import functools
+import gzip
+import logging
+import os
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+import apsw
+
+log = logging.getLogger('red.stats')
+
+# Buffered counters are written every FLUSH_INTERVAL seconds, or sooner
+# once FLUSH_SIZE members have pending counts.
+FLUSH_INTERVAL = 10
+FLUSH_SIZE = 1000
+
+# Daily buckets are kept RETENTION_DAYS days, and pruned every
+# PRUNE_INTERVAL seconds by chunks of PRUNE_CHUNK rows.
+RETENTION_DAYS = 90
+PRUNE_INTERVAL = 3600
+PRUNE_CHUNK = 5000
+
+# Rolling windows shown by the stats: (name, label, days).
+WINDOWS = (('today', "Aujourd'hui", 1), ('7d', '7 jours', 7), ('30d', '30 jours', 30))
+
+
+def month_of(day):
+    """Returns the YYYYMM month of a date ordinal."""
+    day = date.fromordinal(day)
+    return day.year * 100 + day.month
+
+
+def next_month(month):
+    year, month = divmod(month, 100)
+    return (year + month // 12) * 100 + month % 12 + 1
+
+
+def month_days(month):
+    """Returns the first day of a YYYYMM month and of the next one, as date ordinals."""
+    year, number = divmod(month, 100)
+    following = next_month(month)
+    return (
+        date(year, number, 1).toordinal(),
+        date(following // 100, following % 100, 1).toordinal()
+    )
+
+
+def split_by_day(start, end):
+    """Yields (day, seconds) for a voice session, day being a date ordinal."""
+    start = datetime.fromtimestamp(start)
+    end = datetime.fromtimestamp(end)
+    while start.date() < end.date():
+        midnight = datetime.combine(start.date() + timedelta(days=1), datetime.min.time())
+        yield start.toordinal(), round((midnight - start).total_seconds())
+        start = midnight
+    yield start.toordinal(), round((end - start).total_seconds())
+
+
+class StatsStore:
+    """
+    The stats database of one guild.
+
+    Each guild has its own file, writer thread and buffers, so a busy
+    guild never delays the writes of a quiet one, and one guild's data
+    can be reset or exported on its own.
+    """
+
+    def __init__(self, path, loop, legacy=None):
+        self.path = str(path)
+        self.loop = loop
+        # Called in the writer thread when the database is set up, it
+        # returns the path of a stats.db to import into a new file, or
+        # None. It may block until that is known; writes wait meanwhile.
+        self._legacy = legacy
+        self._connection = None
+        self._read_connection = None
+        # Writes go through _executor, reads through _read_executor, so
+        # lookups never wait behind a flush and nothing blocks the loop.
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._read_executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._ready = self._executor.submit(self.setup_db)
+        self._flush_task = None
+        # Pending counts, (day, user_id) -> messages or seconds.
+        self.message_counts = Counter()
+        self.voice_times = Counter()
+        # Open voice sessions, user_id -> timestamp of the join.
+        self.voice_sessions = {}
+
+    def add_message(self, user_id):
+        self.message_counts[(date.today().toordinal(), user_id)] += 1
+        if len(self.message_counts) >= FLUSH_SIZE:
+            self.flush_soon()
+
+    def join_voice(self, user_id, now):
+        self.voice_sessions[user_id] = now
+
+    def leave_voice(self, user_id, now):
+        self._close_session(user_id, now)
+        if len(self.voice_times) >= FLUSH_SIZE:
+            self.flush_soon()
+
+    def _close_session(self, user_id, now):
+        joined_voice_time = self.voice_sessions.pop(user_id, None)
+        if joined_voice_time is None:
+            return
+        for day, time in split_by_day(joined_voice_time, now):
+            self.voice_times[(day, user_id)] += time
+
+    def reconcile_voice(self, user_ids, now):
+        """
+        Matches the open sessions with the members currently in voice.
+
+        Members who joined while the bot was away start a session now.
+        The sessions of members who left unseen are dropped, as when they
+        left is unknown.
+        """
+        for user_id in set(self.voice_sessions).difference(user_ids):
+            del self.voice_sessions[user_id]
+        for user_id in user_ids:
+            self.voice_sessions.setdefault(user_id, now)
+
+    def flush_soon(self):
+        """Starts a flush in the background, unless one is already running."""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = self.loop.create_task(self._flush_logged())
+
+    async def _flush_logged(self):
+        try:
+            await self.flush()
+        except Exception:
+            log.exception('Failed to write stats counters to %s, retrying later', self.path)
+
+    def close(self):
+        """Ends the open sessions, writes what is left in the buffers and stops the threads."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        now = datetime.timestamp(datetime.now())
+        for user_id in list(self.voice_sessions):
+            self._close_session(user_id, now)
+        messages, self.message_counts = self.message_counts, Counter()
+        voice, self.voice_times = self.voice_times, Counter()
+        if messages or voice:
+            self._executor.submit(self.write_counters, list(messages.items()), list(voice.items()))
+        self._executor.shutdown()
+        self._read_executor.shutdown()
+
+    def setup_db(self):
+        """Opens the database and creates the tables, in the writer thread."""
+        new = not os.path.exists(self.path)
+        self._connection = apsw.Connection(self.path)
+        cursor = self._connection.cursor()
+        # auto_vacuum only changes on a new file or through a VACUUM, which
+        # rebuilds the files created before it was enabled, once.
+        if cursor.execute('PRAGMA auto_vacuum;').fetchall()[0][0] != 2:
+            cursor.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+            cursor.execute('VACUUM;')
+        cursor.execute('PRAGMA journal_mode = wal;')
+        # member_stats holds the all-time totals, member_activity the
+        # counters of each day, keyed by date ordinal.
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS member_stats ('
+            'user_id INTEGER NOT NULL,'
+            'message_quantity INTEGER DEFAULT 1,'
+            'voice_time INTEGER DEFAULT 1,'
+            'joined_voice_time INTEGER DEFAULT 1,'
+            'PRIMARY KEY (user_id)'
+            ');'
+        )
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS member_activity ('
+            'user_id INTEGER NOT NULL,'
+            'day INTEGER NOT NULL,'
+            'messages INTEGER NOT NULL DEFAULT 0,'
+            'voice_time INTEGER NOT NULL DEFAULT 0,'
+            'PRIMARY KEY (user_id, day)'
+            ');'
+        )
+        cursor.execute('CREATE INDEX IF NOT EXISTS member_activity_day ON member_activity (day);')
+        # member_windows holds the totals of each rolling window, kept up
+        # to date by write_counters and roll_windows, for the rankings.
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS member_windows ('
+            'days INTEGER NOT NULL,'
+            'user_id INTEGER NOT NULL,'
+            'messages INTEGER NOT NULL DEFAULT 0,'
+            'voice_time INTEGER NOT NULL DEFAULT 0,'
+            'PRIMARY KEY (days, user_id)'
+            ');'
+        )
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS member_windows_messages ON member_windows (days, messages);'
+        )
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS member_windows_voice ON member_windows (days, voice_time);'
+        )
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS member_stats_messages ON member_stats (message_quantity);'
+        )
+        cursor.execute('CREATE INDEX IF NOT EXISTS member_stats_voice ON member_stats (voice_time);')
+        # monthly_stats keeps the totals of every finished month, keyed
+        # by YYYYMM, after its buckets are pruned.
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS monthly_stats ('
+            'month INTEGER NOT NULL,'
+            'user_id INTEGER NOT NULL,'
+            'messages INTEGER NOT NULL DEFAULT 0,'
+            'voice_time INTEGER NOT NULL DEFAULT 0,'
+            'PRIMARY KEY (month, user_id)'
+            ');'
+        )
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS monthly_stats_messages ON monthly_stats (month, messages);'
+        )
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS monthly_stats_voice ON monthly_stats (month, voice_time);'
+        )
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS stats_meta (key TEXT PRIMARY KEY, value INTEGER);'
+        )
+        legacy = self._legacy() if self._legacy is not None else None
+        if legacy is None:
+            return
+        if not new:
+            log.warning('%s already exists, the stats of %s were not migrated', self.path, legacy)
+            return
+        members = self.import_messages(legacy)
+        log.info('Imported the messages of %s members from %s into %s', members, legacy, self.path)
+
+    def safe_read(self, func, *args):
+        """Func for running func(cursor, *args) on the read-only connection in another thread."""
+        self._ready.result()
+        if self._read_connection is None:
+            self._read_connection = apsw.Connection(self.path, flags=apsw.SQLITE_OPEN_READONLY)
+        return func(self._read_connection.cursor(), *args)
+
+    async def read(self, func, *args):
+        task = functools.partial(self.safe_read, func, *args)
+        return await self.loop.run_in_executor(self._read_executor, task)
+
+    async def write(self, func, *args):
+        task = functools.partial(func, *args)
+        return await self.loop.run_in_executor(self._executor, task)
+
+    @staticmethod
+    def top_members(cursor, kind, days, user_id, limit):
+        """Returns the [(user_id, value)] top of a window, and the (rank, value) of user_id."""
+        if days is None:
+            column = 'message_quantity' if kind == 'messages' else 'voice_time'
+            table = 'member_stats'
+            where = '{} > 0'.format(column)
+            args = []
+        else:
+            column = 'messages' if kind == 'messages' else 'voice_time'
+            table = 'member_windows'
+            where = 'days = ? AND {} > 0'.format(column)
+            args = [days]
+        rows = cursor.execute(
+            'SELECT user_id, {column} FROM {table} WHERE {where} '
+            'ORDER BY {column} DESC LIMIT ?'.format(column=column, table=table, where=where),
+            args + [limit]
+        ).fetchall()
+        own = cursor.execute(
+            'SELECT {column} FROM {table} WHERE {where} AND user_id = ?'.format(
+                column=column, table=table, where=where
+            ),
+            args + [user_id]
+        ).fetchall()
+        if not own:
+            return rows, None
+        above = cursor.execute(
+            'SELECT COUNT(*) FROM {table} WHERE {where} AND {column} > ?'.format(
+                column=column, table=table, where=where
+            ),
+            args + [own[0][0]]
+        ).fetchall()
+        return rows, (above[0][0] + 1, own[0][0])
+
+    @staticmethod
+    def month_top(cursor, month, kind, limit):
+        """Returns the [(user_id, value)] top of an archived YYYYMM month."""
+        column = 'messages' if kind == 'messages' else 'voice_time'
+        return cursor.execute(
+            'SELECT user_id, {0} FROM monthly_stats WHERE month = ? AND {0} > 0 '
+            'ORDER BY {0} DESC LIMIT ?'.format(column),
+            [month, limit]
+        ).fetchall()
+
+    @staticmethod
+    def members_query(where=''):
+        """
+        Returns the CSV header and the query of the windows and totals of
+        the members of member_stats, one row each: user_id, the message
+        windows and total, then the voice windows and total.
+        """
+        columns = ['s.user_id']
+        joins = []
+        header = ['user_id']
+        kinds = (('messages', 'messages', 'message_quantity'), ('voice', 'voice_time', 'voice_time'))
+        for kind, column, total in kinds:
+            for name, label, length in WINDOWS:
+                columns.append('COALESCE(w{}.{}, 0)'.format(length, column))
+                header.append('{}_{}'.format(kind, name))
+            columns.append('s.{}'.format(total))
+            header.append('{}_total'.format(kind))
+        for name, label, length in WINDOWS:
+            joins.append(
+                'LEFT JOIN member_windows w{0} '
+                'ON w{0}.days = {0} AND w{0}.user_id = s.user_id'.format(length)
+            )
+        query = 'SELECT {} FROM member_stats s {} {} ORDER BY s.user_id;'.format(
+            ', '.join(columns), ' '.join(joins), where
+        )
+        return header, query
+
+    @classmethod
+    def export_members(cls, cursor, path, get_name):
+        """
+        Writes the windows and totals of every member to a gzipped CSV.
+
+        Rows are streamed from the cursor straight to the file, so memory
+        stays flat whatever the number of members. Returns the row count.
+        """
+        header, query = cls.members_query()
+        rows = 0
+        with gzip.open(path, 'wt', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(header[:1] + ['name'] + header[1:])
+            for row in cursor.execute(query):
+                writer.writerow((row[0], get_name(row[0])) + tuple(row[1:]))
+                rows += 1
+        return rows
+
+    @classmethod
+    def members_activity(cls, cursor, user_ids):
+        """
+        Returns {user_id: ([(window, messages)], [(window, seconds)])} for
+        the given members that have stats, in a single query.
+        """
+        user_ids = list(user_ids)
+        header, query = cls.members_query(
+            'WHERE s.user_id IN ({})'.format(', '.join('?' * len(user_ids)))
+        )
+        labels = [label for name, label, length in WINDOWS] + ['Total']
+        count = len(labels)
+        return {
+            row[0]: (
+                list(zip(labels, row[1:1 + count])),
+                list(zip(labels, row[1 + count:1 + 2 * count]))
+            )
+            for row in cursor.execute(query, user_ids)
+        }
+
+    async def flush(self):
+        """Writes the buffered message and voice counters in one transaction."""
+        messages, self.message_counts = self.message_counts, Counter()
+        voice, self.voice_times = self.voice_times, Counter()
+        if not messages and not voice:
+            return
+        task = functools.partial(
+            self.write_counters, list(messages.items()), list(voice.items())
+        )
+        try:
+            await self.loop.run_in_executor(self._executor, task)
+        except Exception:
+            self.message_counts.update(messages)
+            self.voice_times.update(voice)
+            raise
+
+    def write_counters(self, messages, voice):
+        """Func for adding ((day, user_id), messages) and ((day, user_id), seconds) in another thread."""
+        message_totals = Counter()
+        voice_totals = Counter()
+        for (day, user_id), count in messages:
+            message_totals[user_id] += count
+        for (day, user_id), seconds in voice:
+            voice_totals[user_id] += seconds
+        with self._connection:
+            cursor = self._connection.cursor()
+            today = self.roll_windows()
+            for name, label, length in WINDOWS:
+                cursor.executemany(
+                    'INSERT INTO member_windows (days, user_id, messages) VALUES (?, ?, ?)'
+                    'ON CONFLICT(days, user_id) DO UPDATE SET messages = messages + excluded.messages;',
+                    [
+                        (length, user_id, count)
+                        for (day, user_id), count in messages if day > today - length
+                    ]
+                )
+                cursor.executemany(
+                    'INSERT INTO member_windows (days, user_id, voice_time) VALUES (?, ?, ?)'
+                    'ON CONFLICT(days, user_id) DO UPDATE SET voice_time = voice_time + excluded.voice_time;',
+                    [
+                        (length, user_id, seconds)
+                        for (day, user_id), seconds in voice if day > today - length
+                    ]
+                )
+            cursor.executemany(
+                'INSERT INTO member_activity (user_id, day, messages) VALUES (?, ?, ?)'
+                'ON CONFLICT(user_id, day) DO UPDATE SET messages = messages + excluded.messages;',
+                [(user_id, day, count) for (day, user_id), count in messages]
+            )
+            cursor.executemany(
+                'INSERT INTO member_activity (user_id, day, voice_time) VALUES (?, ?, ?)'
+                'ON CONFLICT(user_id, day) DO UPDATE SET voice_time = voice_time + excluded.voice_time;',
+                [(user_id, day, seconds) for (day, user_id), seconds in voice]
+            )
+            cursor.executemany(
+                'INSERT INTO member_stats (user_id, message_quantity, voice_time, joined_voice_time)'
+                'VALUES (?, ?, 0, 0)'
+                'ON CONFLICT(user_id) DO UPDATE SET '
+                'message_quantity = message_quantity + excluded.message_quantity;',
+                message_totals.items()
+            )
+            cursor.executemany(
+                'INSERT INTO member_stats (user_id, message_quantity, voice_time, joined_voice_time)'
+                'VALUES (?, 0, ?, 0)'
+                'ON CONFLICT(user_id) DO UPDATE SET voice_time = voice_time + excluded.voice_time;',
+                voice_totals.items()
+            )
+
+    def roll_windows(self):
+        """
+        Func for moving the rolling windows to today in another thread.
+
+        Each window holds the buckets of the days after windows_day - days:
+        every new day subtracts the bucket falling out of each window, so
+        the rankings never have to sum the buckets. Returns today.
+        """
+        today = date.today().toordinal()
+        with self._connection:
+            cursor = self._connection.cursor()
+            row = cursor.execute("SELECT value FROM stats_meta WHERE key = 'windows_day';").fetchall()
+            last = row[0][0] if row else None
+            if last == today:
+                return today
+            if last is None or today - last >= WINDOWS[-1][2]:
+                cursor.execute('DELETE FROM member_windows;')
+                for name, label, length in WINDOWS:
+                    cursor.execute(
+                        'INSERT INTO member_windows (days, user_id, messages, voice_time) '
+                        'SELECT ?, user_id, SUM(messages), SUM(voice_time) FROM member_activity '
+                        'WHERE day > ? GROUP BY user_id;',
+                        [length, today - length]
+                    )
+            else:
+                for day in range(last + 1, today + 1):
+                    for name, label, length in WINDOWS:
+                        expired = cursor.execute(
+                            'SELECT messages, voice_time, days, user_id FROM member_activity, '
+                            '(SELECT ? AS days) WHERE day = ?;',
+                            [length, day - length]
+                        ).fetchall()
+                        cursor.executemany(
+                            'UPDATE member_windows SET messages = messages - ?, '
+                            'voice_time = voice_time - ? WHERE days = ? AND user_id = ?;',
+                            expired
+                        )
+                cursor.execute('DELETE FROM member_windows WHERE messages <= 0 AND voice_time <= 0;')
+            cursor.execute(
+                "INSERT OR REPLACE INTO stats_meta (key, value) VALUES ('windows_day', ?);", [today]
+            )
+        return today
+
+    def archive_months(self):
+        """
+        Func for copying the totals of every finished month to monthly_stats in another thread.
+
+        Each month is summed from its buckets in one transaction, before
+        the retention prunes them. Months whose buckets are all still
+        retained are summed again, so the counts written after a month
+        ended (late flushes, voice sessions across midnight) reach it too.
+        """
+        today = date.today().toordinal()
+        current = month_of(today)
+        # The first month none of whose buckets can have been pruned yet.
+        retained = month_of(today - RETENTION_DAYS)
+        if month_days(retained)[0] < today - RETENTION_DAYS:
+            retained = next_month(retained)
+        with self._connection:
+            cursor = self._connection.cursor()
+            row = cursor.execute("SELECT value FROM stats_meta WHERE key = 'archived_month';").fetchall()
+            if row:
+                month = min(next_month(row[0][0]), retained)
+            else:
+                first = cursor.execute('SELECT MIN(day) FROM member_activity;').fetchall()[0][0]
+                month = month_of(first) if first is not None else current
+            archived = None
+            while month < current:
+                start, end = month_days(month)
+                cursor.execute(
+                    'INSERT OR REPLACE INTO monthly_stats (month, user_id, messages, voice_time) '
+                    'SELECT ?, user_id, SUM(messages), SUM(voice_time) FROM member_activity '
+                    'WHERE day >= ? AND day < ? GROUP BY user_id;',
+                    [month, start, end]
+                )
+                archived = month
+                month = next_month(month)
+            if archived is not None:
+                cursor.execute(
+                    "INSERT OR REPLACE INTO stats_meta (key, value) VALUES ('archived_month', ?);",
+                    [archived]
+                )
+
+    def import_messages(self, path):
+        """
+        Func for adding the message counts of a stats.db of older versions in another thread.
+
+        That file was emptied on the first of every month, so its counts
+        only cover the current month, and its voice times were corrupted
+        by the leave upsert: only message_quantity is imported.
+        Returns the number of members imported.
+        """
+        cursor = self._connection.cursor()
+        cursor.execute('ATTACH DATABASE ? AS legacy;', [path])
+        try:
+            with self._connection:
+                cursor.execute(
+                    'INSERT INTO member_stats (user_id, message_quantity, voice_time, joined_voice_time) '
+                    'SELECT user_id, message_quantity, 0, 0 FROM legacy.member_stats WHERE true '
+                    'ON CONFLICT(user_id) DO UPDATE SET '
+                    'message_quantity = message_quantity + excluded.message_quantity;'
+                )
+                return self._connection.changes()
+        finally:
+            cursor.execute('DETACH DATABASE legacy;')
+
+    def compact(self):
+        """Func for giving the freed pages back and truncating the WAL in another thread."""
+        cursor = self._connection.cursor()
+        cursor.execute('PRAGMA incremental_vacuum;').fetchall()
+        cursor.execute('PRAGMA wal_checkpoint(TRUNCATE);').fetchall()
+
+    async def prune(self):
+        """
+        Writes the buffered counters, rolls the windows and archives the
+        finished months, then deletes the buckets past the retention chunk
+        by chunk and compacts the file.
+        """
+        await self.flush()
+        await self.write(self.roll_windows)
+        await self.write(self.archive_months)
+        oldest = date.today().toordinal() - RETENTION_DAYS
+        while await self.write(self.prune_activity, oldest, PRUNE_CHUNK) == PRUNE_CHUNK:
+            # Let the pending flushes through between chunks.
+            await asyncio.sleep(1)
+        await self.write(self.compact)
+
+    def prune_activity(self, oldest, limit):
+        """Func for deleting up to limit buckets older than oldest in another thread."""
+        with self._connection:
+            self._connection.cursor().execute(
+                'DELETE FROM member_activity WHERE rowid IN ('
+                'SELECT rowid FROM member_activity WHERE day < ? LIMIT ?'
+                ');',
+                [oldest, limit]
+            )
+            return self._connection.changes()